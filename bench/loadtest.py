@@ -0,0 +1,476 @@
+"""Teste de carga do fluxo de domingo contra um servidor rodando (só stdlib).
+
+    python bench/loadtest.py --url http://127.0.0.1:5000 --usuarios 50 --duracao 60 --mix domingo
+    python bench/loadtest.py ... --salvar-baseline bench/baseline.json
+    python bench/loadtest.py ... --comparar bench/baseline.json
+
+Cada usuário virtual é uma thread com conexão keep-alive e seu próprio cache de ETag
+(como o navegador), logada com uma das contas bench001.. criadas pelo seed.py. As ações
+são sorteadas pelo peso do mix; o mix "domingo" começa com a rajada de check-ins e depois
+passa para chamada, mural, saídas e buscas.
+
+Com --eventos cada usuário também mantém um /api/eventos aberto, como o app no navegador,
+para medir a API com os streams SSE ocupando threads do servidor.
+
+Relata por endpoint: p50/p95/p99, req/s, erros, fração de 304, consultas ao banco por
+requisição (cabeçalho X-DB-Queries) e KB por resposta. --comparar sai com código 1 se
+algum p95 piorar além de --tolerancia.
+"""
+import argparse
+import gzip
+import http.client
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from urllib.parse import urlencode, urlsplit
+
+# (fração da duração, pesos das ações)
+MIXES = {
+    "domingo": [
+        (0.35, {"entrada": 60, "sugestoes": 20, "presentes": 15, "estatisticas": 5}),
+        (0.65, {"presentes": 30, "mural": 20, "saida": 15, "busca": 10, "like": 5,
+                "comentarios": 5, "historico": 5, "estatisticas": 5, "sugestoes": 5}),
+    ],
+    "checkin": [(1.0, {"entrada": 65, "sugestoes": 20, "presentes": 15})],
+    "mural": [(1.0, {"mural": 65, "like": 15, "comentarios": 10, "estatisticas": 10})],
+    "leitura": [(1.0, {"presentes": 25, "mural": 25, "busca": 20, "historico": 15, "estatisticas": 15})],
+}
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--url", default="http://127.0.0.1:5000")
+    p.add_argument("--mix", choices=sorted(MIXES), default="domingo")
+    p.add_argument("--usuarios", type=int, default=50, help="usuários virtuais simultâneos")
+    p.add_argument("--duracao", type=float, default=60, help="segundos medidos")
+    p.add_argument("--aquecimento", type=float, default=5, help="segundos iniciais fora da medição")
+    p.add_argument("--pausa", type=float, default=0.5, help="pausa média entre ações (s, exponencial)")
+    p.add_argument("--contas", type=int, default=40, help="quantas contas benchNNN usar")
+    p.add_argument("--senha", default="bench")
+    p.add_argument("--admin", default="admin:1234", help="usuario:senha para abrir aula se não houver")
+    p.add_argument("--sem-compressao", action="store_true")
+    p.add_argument("--eventos", action="store_true", help="um stream SSE aberto por usuário")
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--saida", help="grava o resultado em JSON")
+    p.add_argument("--salvar-baseline", metavar="ARQUIVO")
+    p.add_argument("--comparar", metavar="ARQUIVO")
+    p.add_argument("--tolerancia", type=float, default=0.2, help="piora aceitável do p95 (0.2 = 20%%)")
+    return p.parse_args()
+
+
+class Client:
+    """Conexão HTTP keep-alive de um usuário virtual."""
+
+    def __init__(self, base_url, compress=True):
+        u = urlsplit(base_url)
+        self.https = u.scheme == "https"
+        self.host = u.hostname
+        self.port = u.port or (443 if self.https else 80)
+        self.compress = compress
+        self.token = None
+        self.etags = {}
+        self.conn = None
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        self.conn = cls(self.host, self.port, timeout=30)
+
+    def request(self, method, path, body=None, revalidate=False):
+        """Devolve (status, headers, corpo decodificado ou None, bytes recebidos)."""
+        headers = {"Accept": "application/json"}
+        if self.compress:
+            headers["Accept-Encoding"] = "gzip"
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        if revalidate and path in self.etags:
+            headers["If-None-Match"] = self.etags[path][0]
+
+        for tentativa in (1, 2):
+            if self.conn is None:
+                self._connect()
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                resp = self.conn.getresponse()
+                raw = resp.read()
+                break
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if tentativa == 2:
+                    raise
+
+        data = raw
+        if resp.getheader("Content-Encoding") == "gzip":
+            data = gzip.decompress(raw)
+        if resp.status == 304 and path in self.etags:
+            data = self.etags[path][1]
+        elif revalidate and resp.status == 200 and resp.getheader("ETag"):
+            self.etags[path] = (resp.getheader("ETag"), data)
+        return resp.status, resp, data, len(raw)
+
+    def json(self, method, path, body=None):
+        status, _, data, _ = self.request(method, path, body)
+        try:
+            return status, json.loads(data) if data else None
+        except ValueError:
+            return status, None
+
+
+class Shared:
+    """Estado comum aos usuários virtuais (ids conhecidos e presenças abertas)."""
+
+    def __init__(self, alunos, nomes, avisos):
+        self.alunos = alunos
+        self.nomes = nomes
+        self.avisos = avisos
+        self.abertas = []
+        self.lock = threading.Lock()
+
+    def add_frequencia(self, fid):
+        with self.lock:
+            self.abertas.append(fid)
+
+    def pop_frequencia(self, rng):
+        with self.lock:
+            if not self.abertas:
+                return None
+            i = rng.randrange(len(self.abertas))
+            self.abertas[i], self.abertas[-1] = self.abertas[-1], self.abertas[i]
+            return self.abertas.pop()
+
+
+def prefixo(rng, nomes):
+    nome = rng.choice(nomes)
+    return nome[:rng.randint(3, min(6, len(nome)))] if len(nome) >= 3 else nome
+
+
+def run_action(acao, client, shared, rng):
+    """Executa uma ação; devolve (nome do endpoint, status, resposta, bytes)."""
+    if acao == "entrada":
+        status, resp, data, n = client.request("POST", "/api/aulas/entrada", {"aluno_id": rng.choice(shared.alunos)})
+        if status == 200:
+            fid = (json.loads(data) or {}).get("frequencia_id")
+            if fid:
+                shared.add_frequencia(fid)
+        return "aulas_entrada", status, resp, n
+    if acao == "saida":
+        fid = shared.pop_frequencia(rng)
+        if fid is None:
+            acao = "presentes"
+        else:
+            status, resp, _, n = client.request("POST", "/api/aulas/saida",
+                                                {"frequencia_id": fid, "retirado_por": "Responsável"})
+            return "aulas_saida", status, resp, n
+    if acao == "presentes":
+        status, resp, _, n = client.request("GET", "/api/aulas/presentes", revalidate=True)
+        return "aulas_presentes", status, resp, n
+    if acao == "sugestoes":
+        q = urlencode({"q": prefixo(rng, shared.nomes)})
+        status, resp, _, n = client.request("GET", f"/api/alunos/sugestoes?{q}")
+        return "alunos_sugestoes", status, resp, n
+    if acao == "busca":
+        q = urlencode({"q": prefixo(rng, shared.nomes)})
+        status, resp, _, n = client.request("GET", f"/api/alunos?{q}", revalidate=True)
+        return "alunos_list (busca)", status, resp, n
+    if acao == "mural":
+        status, resp, _, n = client.request("GET", "/api/avisos?limit=20", revalidate=True)
+        return "avisos_list", status, resp, n
+    if acao == "like" and shared.avisos:
+        method = rng.choice(("PUT", "DELETE"))
+        status, resp, _, n = client.request(method, f"/api/avisos/{rng.choice(shared.avisos)}/like")
+        return f"aviso_like ({method})", status, resp, n
+    if acao == "comentarios" and shared.avisos:
+        path = f"/api/avisos/{rng.choice(shared.avisos)}/comentarios?limit=20"
+        status, resp, _, n = client.request("GET", path, revalidate=True)
+        return "comentarios_list", status, resp, n
+    if acao == "historico":
+        status, resp, _, n = client.request("GET", "/api/historico?limit=50", revalidate=True)
+        return "historico_listar", status, resp, n
+    status, resp, _, n = client.request("GET", "/api/estatisticas")
+    return "estatisticas", status, resp, n
+
+
+def event_stream(args, token, stop, contagem):
+    """Mantém um /api/eventos aberto como o EventSource do app: reconecta após o retry.
+
+    Como o app, pede um token de eventos (curto) a cada conexão; o token da sessão não vai na URL.
+    """
+    u = urlsplit(args.url)
+    cls = http.client.HTTPSConnection if u.scheme == "https" else http.client.HTTPConnection
+    api = Client(args.url, compress=False)
+    api.token = token
+    retry, last_id, reconexao = 3.0, None, False
+    while not stop.is_set():
+        try:
+            status, data = api.json("POST", "/api/eventos/token")
+        except (http.client.HTTPException, OSError):
+            status, data = None, None
+        if status != 200 or not data:
+            contagem["erros"] += 1
+            stop.wait(retry)
+            continue
+        qs = {"token": data["token"]}
+        if reconexao:
+            qs["reconexao"] = "1"
+        path = "/api/eventos?" + urlencode(qs)
+        conn = cls(u.hostname, u.port or (443 if u.scheme == "https" else 80), timeout=60)
+        headers = {"Accept": "text/event-stream"}
+        if last_id is not None:
+            headers["Last-Event-ID"] = last_id
+        try:
+            conn.request("GET", path, headers=headers)
+            resp = conn.getresponse()
+            if resp.status != 200:
+                # o EventSource desiste com status diferente de 200; o app então pede outro token
+                contagem["erros"] += 1
+                reconexao = True
+                stop.wait(retry)
+                continue
+            while not stop.is_set():
+                line = resp.readline()
+                if not line:
+                    break
+                line = line.decode().rstrip("\r\n")
+                if line.startswith("retry:"):
+                    retry = int(line[6:]) / 1000
+                elif line.startswith("id:"):
+                    last_id = line[3:].strip()
+                elif line == ": conectado":
+                    contagem["abertos"] += 1
+                elif line == ": ocupado":
+                    contagem["recusados"] += 1
+                elif line.startswith("event:"):
+                    contagem["eventos"] += 1
+        except (http.client.HTTPException, OSError):
+            contagem["quedas"] += 1
+        finally:
+            conn.close()
+        reconexao = True
+        stop.wait(retry)
+
+
+def pick(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def phase_weights(mix, frac):
+    acumulado = 0.0
+    for fracao, weights in mix:
+        acumulado += fracao
+        if frac < acumulado:
+            return weights
+    return mix[-1][1]
+
+
+def virtual_user(i, args, shared, clock, stats, barrier, stop, contagem):
+    rng = random.Random(args.seed + i)
+    client = Client(args.url, compress=not args.sem_compressao)
+    conta = f"bench{(i % args.contas) + 1:03d}"
+    status, data = client.json("POST", "/api/login", {"usuario": conta, "senha": args.senha})
+    if status != 200 or not data or not data.get("token"):
+        print(f"⚠️ login falhou para {conta} ({status})", file=sys.stderr)
+        barrier.wait()
+        return
+    client.token = data["token"]
+    if args.eventos:
+        threading.Thread(target=event_stream, args=(args, client.token, stop, contagem), daemon=True).start()
+    barrier.wait()
+
+    t_start, t_measure, t_end = clock["inicio"], clock["medicao"], clock["fim"]
+    mix = MIXES[args.mix]
+    total = t_end - t_start
+    while True:
+        now = time.monotonic()
+        if now >= t_end:
+            break
+        acao = pick(rng, phase_weights(mix, (now - t_start) / total))
+        started = time.perf_counter()
+        try:
+            nome, status, resp, nbytes = run_action(acao, client, shared, rng)
+            queries = resp.getheader("X-DB-Queries")
+        except Exception:
+            nome, status, queries, nbytes = acao, 0, None, 0
+        elapsed = time.perf_counter() - started
+
+        if time.monotonic() >= t_measure:
+            s = stats[nome]
+            s["lat"].append(elapsed)
+            s["bytes"] += nbytes
+            if status == 304:
+                s["304"] += 1
+            elif status == 0 or status >= 400:
+                s["erros"] += 1
+            if queries is not None:
+                s["db"] += int(queries)
+                s["db_n"] += 1
+        if args.pausa > 0:
+            time.sleep(min(rng.expovariate(1 / args.pausa), args.pausa * 5))
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[k]
+
+
+def summarize(stats_list, duracao):
+    merged = defaultdict(lambda: {"lat": [], "bytes": 0, "304": 0, "erros": 0, "db": 0, "db_n": 0})
+    for stats in stats_list:
+        for nome, s in stats.items():
+            m = merged[nome]
+            m["lat"].extend(s["lat"])
+            for k in ("bytes", "304", "erros", "db", "db_n"):
+                m[k] += s[k]
+
+    def resumo(s):
+        lat = sorted(s["lat"])
+        n = len(lat)
+        return {
+            "n": n,
+            "rps": round(n / duracao, 2),
+            "p50_ms": round(percentile(lat, 50) * 1000, 2) if n else None,
+            "p95_ms": round(percentile(lat, 95) * 1000, 2) if n else None,
+            "p99_ms": round(percentile(lat, 99) * 1000, 2) if n else None,
+            "erros": s["erros"],
+            "pct_304": round(100 * s["304"] / n, 1) if n else 0,
+            "db_por_req": round(s["db"] / s["db_n"], 2) if s["db_n"] else None,
+            "kb_por_req": round(s["bytes"] / n / 1024, 2) if n else 0,
+        }
+
+    total = {"lat": [], "bytes": 0, "304": 0, "erros": 0, "db": 0, "db_n": 0}
+    for s in merged.values():
+        total["lat"].extend(s["lat"])
+        for k in ("bytes", "304", "erros", "db", "db_n"):
+            total[k] += s[k]
+    return {nome: resumo(s) for nome, s in sorted(merged.items())}, resumo(total)
+
+
+def print_table(endpoints, total):
+    cols = ("n", "rps", "p50_ms", "p95_ms", "p99_ms", "erros", "pct_304", "db_por_req", "kb_por_req")
+    print(f"{'endpoint':<24}" + "".join(f"{c:>11}" for c in cols))
+    for nome, r in list(endpoints.items()) + [("TOTAL", total)]:
+        print(f"{nome:<24}" + "".join(f"{'-' if r[c] is None else r[c]:>11}" for c in cols))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline_path, endpoints, tolerancia):
+    with open(baseline_path, encoding="utf-8") as f:
+        base = json.load(f)
+    print(f"\ncomparando com {baseline_path} (revisão {base.get('revisao') or '?'}, {base.get('data')})")
+    regressoes = 0
+    for nome, atual in endpoints.items():
+        antes = base.get("endpoints", {}).get(nome)
+        if not antes or not antes.get("p95_ms") or atual["p95_ms"] is None:
+            continue
+        delta = (atual["p95_ms"] - antes["p95_ms"]) / antes["p95_ms"]
+        # diferenças de poucos ms são ruído de medição
+        piorou = delta > tolerancia and atual["p95_ms"] - antes["p95_ms"] > 2
+        regressoes += piorou
+        marca = "  REGRESSÃO" if piorou else ""
+        print(f"{nome:<24} p95 {antes['p95_ms']:>9} -> {atual['p95_ms']:>9} ms ({delta:+.0%})"
+              f"  db/req {antes.get('db_por_req')} -> {atual['db_por_req']}{marca}")
+    return regressoes
+
+
+def setup(args):
+    client = Client(args.url, compress=not args.sem_compressao)
+    usuario, _, senha = args.admin.partition(":")
+    status, data = client.json("POST", "/api/login", {"usuario": usuario, "senha": senha})
+    if status != 200:
+        sys.exit(f"login de {usuario} falhou ({status}); ajuste --admin")
+    client.token = data["token"]
+
+    _, ativa = client.json("GET", "/api/aulas/ativa")
+    if not (ativa or {}).get("aula"):
+        client.json("POST", "/api/aulas/iniciar", {"tema": "Carga", "professor": "Bench"})
+
+    alunos, nomes, cursor = [], [], None
+    while len(alunos) < 5000:
+        q = urlencode({"limit": 500, **({"cursor": cursor} if cursor else {})})
+        _, page = client.json("GET", f"/api/alunos?{q}")
+        for a in (page or {}).get("items", []):
+            alunos.append(a["id"])
+            nomes.append(a.get("nome") or "")
+        cursor = (page or {}).get("next_cursor")
+        if not cursor:
+            break
+    _, avisos = client.json("GET", "/api/avisos?limit=100")
+    avisos = [a["id"] for a in (avisos or {}).get("items", [])]
+    if not alunos:
+        sys.exit("nenhum aluno cadastrado: rode bench/seed.py antes")
+    return Shared(alunos, [n for n in nomes if n] or ["a"], avisos)
+
+
+def main():
+    args = parse_args()
+    shared = setup(args)
+    print(f"{len(shared.alunos)} alunos, {len(shared.avisos)} avisos; "
+          f"{args.usuarios} usuários, mix {args.mix}, {args.duracao:.0f}s (+{args.aquecimento:.0f}s aquecimento)")
+
+    stats_list = [defaultdict(lambda: {"lat": [], "bytes": 0, "304": 0, "erros": 0, "db": 0, "db_n": 0})
+                  for _ in range(args.usuarios)]
+    clock = {}
+
+    def start_clock():
+        # o relógio só começa quando todos já logaram
+        t = time.monotonic()
+        clock.update(inicio=t, medicao=t + args.aquecimento, fim=t + args.aquecimento + args.duracao)
+
+    barrier = threading.Barrier(args.usuarios, action=start_clock)
+    stop = threading.Event()
+    contagens = [defaultdict(int) for _ in range(args.usuarios)]
+    threads = [threading.Thread(target=virtual_user, daemon=True,
+                                args=(i, args, shared, clock, stats_list[i], barrier, stop, contagens[i]))
+               for i in range(args.usuarios)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stop.set()
+    eventos = {k: sum(c[k] for c in contagens) for k in ("abertos", "recusados", "quedas", "erros", "eventos")}
+
+    endpoints, total = summarize(stats_list, args.duracao)
+    print()
+    print_table(endpoints, total)
+    if args.eventos:
+        print(f"\nSSE: {eventos['abertos']} streams abertos, {eventos['recusados']} recusados (limite do worker), "
+              f"{eventos['quedas']} quedas, {eventos['erros']} erros, {eventos['eventos']} eventos recebidos")
+
+    result = {
+        "revisao": git_revision(),
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "parametros": {k: getattr(args, k) for k in ("url", "mix", "usuarios", "duracao", "aquecimento",
+                                                     "pausa", "sem_compressao", "eventos", "seed")},
+        "endpoints": endpoints,
+        "total": total,
+        "eventos": eventos if args.eventos else None,
+    }
+    for path in filter(None, (args.saida, args.salvar_baseline)):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"resultado gravado em {path}")
+
+    if args.comparar and compare(args.comparar, endpoints, args.tolerancia):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""Popula um Postgres de teste com volumes realistas para os testes de carga.
+
+    DB_HOST=localhost DB_USER=postgres DB_PASS=postgres DB_SSLMODE=disable \
+        python bench/seed.py --reset --alunos 3000 --anos 3
+
+Usa as mesmas variáveis DB_* e MEDIA_* do server.py. Recusa hosts que não sejam locais
+(--permitir-remoto para forçar), porque o padrão do server.py aponta para produção.
+Com o mesmo --seed os volumes e os dados gerados em Python são os mesmos; as presenças
+e curtidas são sorteadas no banco com setseed().
+
+Cria as contas bench001..benchNNN (senha "bench") usadas pelo loadtest.py e deixa uma
+aula aberta para o check-in.
+"""
+import argparse
+import base64
+import io
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+NOMES = [
+    "Ana", "Beatriz", "Bruno", "Caio", "Camila", "Davi", "Eduarda", "Enzo", "Gabriel", "Giovanna",
+    "Heitor", "Helena", "Isabela", "João", "Júlia", "Laura", "Lucas", "Manuela", "Maria", "Mariana",
+    "Matheus", "Miguel", "Nicolas", "Pedro", "Rafael", "Samuel", "Sofia", "Théo", "Valentina", "Vitória",
+]
+SOBRENOMES = [
+    "Almeida", "Araújo", "Barbosa", "Cardoso", "Carvalho", "Costa", "Dias", "Fernandes", "Ferreira", "Gomes",
+    "Lima", "Martins", "Melo", "Oliveira", "Pereira", "Ribeiro", "Rocha", "Rodrigues", "Santos", "Silva",
+    "Sousa", "Teixeira",
+]
+TEMAS = ["Davi e Golias", "A arca de Noé", "O bom samaritano", "Jonas", "A criação", "Daniel na cova dos leões",
+         "O filho pródigo", "A multiplicação dos pães", "José do Egito", "Zaqueu"]
+MENSAGENS = ["Culto da família neste domingo!", "Ensaio do coral às 18h.", "Tragam uma fruta para o lanche.",
+             "Reunião de professores após o culto.", "Festa das crianças no próximo sábado!",
+             "Lembrem de trazer a autorização do passeio."]
+COMENTARIOS = ["Amém!", "Glória a Deus!", "Estaremos lá", "Obrigado pelo aviso", "🙏", "Que bênção!"]
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--reset", action="store_true", help="apaga os dados existentes antes (mantém o admin)")
+    p.add_argument("--alunos", type=int, default=3000)
+    p.add_argument("--equipe", type=int, default=40, help="contas bench001..benchNNN")
+    p.add_argument("--anos", type=float, default=3, help="anos de histórico de aulas")
+    p.add_argument("--aulas-por-semana", type=int, default=2)
+    p.add_argument("--presenca", type=float, default=0.35, help="chance média de cada aluno vir a uma aula")
+    p.add_argument("--avisos", type=int, default=600)
+    p.add_argument("--curtidas-por-aviso", type=float, default=8)
+    p.add_argument("--comentarios-por-aviso", type=float, default=2)
+    p.add_argument("--fotos", type=float, default=0.7, help="fração de alunos/equipe/avisos com imagem")
+    p.add_argument("--fotos-distintas", type=int, default=60, help="quantas imagens diferentes gerar")
+    p.add_argument("--fotos-legado", action="store_true",
+                   help="grava as fotos como base64 nas colunas (formato antigo, para testar migrar-midia)")
+    p.add_argument("--sem-aula-aberta", action="store_true")
+    p.add_argument("--permitir-remoto", action="store_true")
+    return p.parse_args()
+
+
+def check_target(args):
+    host = os.getenv("DB_HOST")
+    if not host:
+        sys.exit("Defina DB_HOST (e DB_USER/DB_PASS/DB_SSLMODE) apontando para o banco de teste")
+    if host not in LOCAL_HOSTS and not args.permitir_remoto:
+        sys.exit(f"DB_HOST={host} não é local; use --permitir-remoto se for mesmo um banco de teste")
+
+
+def fake_photo(rng, size=360):
+    """JPEG com formas e ruído: comprime como uma foto de celular, não como uma cor chapada."""
+    from PIL import Image, ImageDraw
+
+    fundo = tuple(rng.randrange(60, 220) for _ in range(3))
+    img = Image.new("RGB", (size, size), fundo)
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(size), rng.randrange(size)
+        r = rng.randrange(20, size // 2)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    ruido = Image.frombytes("L", (size, size), rng.randbytes(size * size))
+    img = Image.blend(img, Image.merge("RGB", (ruido, ruido, ruido)), 0.2)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+def make_photos(server, rng, args):
+    fotos = []
+    for _ in range(args.fotos_distintas):
+        b64 = base64.b64encode(fake_photo(rng)).decode()
+        fotos.append(f"data:image/jpeg;base64,{b64}" if args.fotos_legado else server.store_image(b64))
+    return fotos
+
+
+def maybe_photo(rng, fotos, args):
+    return rng.choice(fotos) if fotos and rng.random() < args.fotos else None
+
+
+def nome_completo(rng):
+    return f"{rng.choice(NOMES)} {rng.choice(SOBRENOMES)} {rng.choice(SOBRENOMES)}"
+
+
+def telefone(rng):
+    return f"(11) 9{rng.randrange(1000, 9999)}-{rng.randrange(1000, 9999)}"
+
+
+def reset(cur):
+    cur.execute("""
+        TRUNCATE frequencia, analytics_aulas_processadas, analytics_alunos, analytics_mensal,
+                 analytics_professores, aulas, avisos_comentarios, avisos_likes, avisos, alunos
+        RESTART IDENTITY CASCADE
+    """)
+    cur.execute("DELETE FROM usuarios WHERE usuario <> 'admin'")
+
+
+def seed_equipe(cur, rng, fotos, args):
+    from psycopg2.extras import execute_values
+
+    rows = [
+        (nome_completo(rng), f"bench{i:03d}", "bench", "membro", telefone(rng), f"bench{i:03d}@example.com",
+         maybe_photo(rng, fotos, args))
+        for i in range(1, args.equipe + 1)
+    ]
+    execute_values(cur, """
+        INSERT INTO usuarios (nome, usuario, senha, role, telefone, email, foto) VALUES %s
+        ON CONFLICT (usuario) DO NOTHING
+    """, rows, page_size=500)
+    cur.execute("SELECT id, nome FROM usuarios ORDER BY id")
+    return cur.fetchall()
+
+
+def seed_alunos(cur, rng, fotos, args):
+    from psycopg2.extras import execute_values
+
+    hoje = datetime.now()
+    rows = []
+    while len(rows) < args.alunos:
+        # irmãos dividem o responsável, como no check-in real
+        responsavel = nome_completo(rng)
+        for _ in range(min(rng.choice((1, 1, 1, 2, 2, 3)), args.alunos - len(rows))):
+            nascimento = hoje - timedelta(days=rng.randrange(3 * 365, 12 * 365))
+            rows.append((
+                f"{rng.choice(NOMES)} {responsavel.split(' ', 1)[1]}",
+                nascimento.strftime("%Y-%m-%d"),
+                responsavel,
+                telefone(rng),
+                "" if rng.random() < 0.8 else "Alergia a amendoim",
+                responsavel,
+                nome_completo(rng) if rng.random() < 0.5 else "",
+                "",
+                maybe_photo(rng, fotos, args),
+            ))
+    execute_values(cur, """
+        INSERT INTO alunos (nome, data_nascimento, responsavel, telefone, observacoes,
+                            autorizado_retirar, autorizado_2, autorizado_3, foto)
+        VALUES %s
+    """, rows, page_size=1000)
+
+
+def seed_aulas(cur, rng, equipe, args):
+    from psycopg2.extras import execute_values
+
+    semanas = int(args.anos * 52)
+    inicio = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0) - timedelta(weeks=semanas)
+    horarios = [timedelta(days=0), timedelta(hours=2), timedelta(days=3, hours=10)][:max(1, args.aulas_por_semana)]
+    rows = []
+    for semana in range(semanas):
+        for h in horarios:
+            quando = inicio + timedelta(weeks=semana) + h
+            prof, aux = rng.sample(equipe, 2) if len(equipe) > 1 else (equipe[0], None)
+            professores = f"{prof['nome']} / Aux: {aux['nome']}" if aux else prof["nome"]
+            rows.append((quando, rng.choice(TEMAS), professores, quando + timedelta(hours=2)))
+    execute_values(cur, "INSERT INTO aulas (data_aula, tema, professores, encerrada_em) VALUES %s",
+                   rows, page_size=1000)
+    return len(rows)
+
+
+def seed_frequencia(cur, server, args):
+    cur.execute("SELECT setseed(%s)", ((args.seed % 1000) / 1000.0,))
+    # assiduidade varia por criança (entre 0.5x e 1.5x a média)
+    cur.execute("""
+        INSERT INTO frequencia (id_aula, id_aluno, horario_entrada, horario_saida, retirado_por)
+        SELECT au.id, al.id,
+               au.data_aula + random() * INTERVAL '25 minutes',
+               au.data_aula + INTERVAL '95 minutes' + random() * INTERVAL '30 minutes',
+               al.responsavel
+        FROM aulas au CROSS JOIN alunos al
+        WHERE au.encerrada_em IS NOT NULL
+          AND random() < %s * (0.5 + ((al.id * 7919) %% 100) / 100.0)
+    """, (args.presenca,))
+    n = cur.rowcount
+    cur.execute(f"UPDATE aulas a SET {server.AULA_CONTAGEM_SET}")
+    return n
+
+
+def seed_mural(cur, rng, fotos, equipe, args):
+    from psycopg2.extras import execute_values
+
+    agora = datetime.now()
+    rows = []
+    for i in range(args.avisos):
+        autor = rng.choice(equipe)
+        rows.append((
+            rng.choice(MENSAGENS),
+            agora - timedelta(minutes=rng.randrange(int(args.anos * 365 * 24 * 60) or 1)),
+            autor["nome"], autor["id"],
+            maybe_photo(rng, fotos, args),
+            i < 3,
+        ))
+    execute_values(cur, """
+        INSERT INTO avisos (mensagem, data_criacao, autor, autor_id, imagem, fixado) VALUES %s
+    """, rows, page_size=1000)
+
+    cur.execute("SELECT setseed(%s)", ((args.seed % 1000) / 1000.0,))
+    cur.execute("""
+        INSERT INTO avisos_likes (aviso_id, user_id, created_at)
+        SELECT av.id, u.id, av.data_criacao + random() * INTERVAL '2 days'
+        FROM avisos av CROSS JOIN usuarios u
+        WHERE random() < %s
+        ON CONFLICT DO NOTHING
+    """, (min(1.0, args.curtidas_por_aviso / max(1, len(equipe))),))
+    cur.execute("""
+        INSERT INTO avisos_comentarios (aviso_id, user_id, user_nome, texto, created_at)
+        SELECT av.id, u.id, u.nome, (%s::text[])[1 + floor(random() * %s)::int],
+               av.data_criacao + random() * INTERVAL '2 days'
+        FROM avisos av CROSS JOIN usuarios u
+        WHERE random() < %s
+    """, (COMENTARIOS, len(COMENTARIOS), min(1.0, args.comentarios_por_aviso / max(1, len(equipe)))))
+
+
+def main():
+    args = parse_args()
+    check_target(args)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import server
+
+    server.migrate()
+    rng = random.Random(args.seed)
+    started = time.monotonic()
+
+    with server.db() as conn, conn.cursor() as cur:
+        if args.reset:
+            reset(cur)
+            conn.commit()
+
+        fotos = make_photos(server, rng, args) if args.fotos > 0 else []
+        equipe = seed_equipe(cur, rng, fotos, args)
+        seed_alunos(cur, rng, fotos, args)
+        conn.commit()
+        print(f"equipe e {args.alunos} alunos ({len(fotos)} fotos distintas)")
+
+        n_aulas = seed_aulas(cur, rng, equipe, args)
+        n_freq = seed_frequencia(cur, server, args)
+        conn.commit()
+        print(f"{n_aulas} aulas, {n_freq} presenças")
+
+        seed_mural(cur, rng, fotos, equipe, args)
+        conn.commit()
+        print(f"{args.avisos} avisos com curtidas e comentários")
+
+        if not args.sem_aula_aberta:
+            cur.execute("UPDATE aulas SET encerrada_em = NOW() WHERE encerrada_em IS NULL")
+            cur.execute("INSERT INTO aulas (data_aula, tema, professores) VALUES (NOW(), 'Carga', %s)",
+                        (equipe[0]["nome"],))
+            conn.commit()
+
+    server.recontar_avisos([])
+    server.recalcular_analytics([])
+    with server.db() as conn, conn.cursor() as cur:
+        conn.autocommit = True
+        cur.execute("ANALYZE")
+        conn.autocommit = False
+    print(f"pronto em {time.monotonic() - started:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
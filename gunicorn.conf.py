@@ -0,0 +1,114 @@
+"""Configuração do gunicorn (Procfile: `gunicorn server:app -c gunicorn.conf.py`).
+
+Dois modos de concorrência suportados, escolhidos por WORKER_CLASS:
+
+gthread (padrão)
+    Cada worker é um processo com WEB_THREADS threads. Uma requisição esperando o
+    Supabase ou um celular lento ocupa só uma thread, não o worker. O acesso ao banco
+    passa pelo ConnectionPool do server.py, que é thread-safe e limita as conexões
+    a DB_POOL_MAX por processo. Cada stream SSE (/api/eventos) segura uma thread
+    enquanto está aberto (até SSE_MAX_SECONDS), mas não segura conexão do banco.
+
+gevent
+    Green threads cooperativas: milhares de conexões paradas custam pouca memória.
+    O psycopg2 fica não-bloqueante via psycogreen (patch no post_fork abaixo).
+    Exige `pip install gevent psycogreen`. Trabalho de CPU, como a geração de
+    miniaturas com Pillow, bloqueia o loop do worker enquanto roda. Com o psycogreen
+    o psycopg2 não faz COPY, então /api/alunos/importar responde 503 e a importação
+    de CSV fica só pelo `python server.py importar-alunos`.
+
+Streams SSE
+    O app abre um /api/eventos a cada carregamento. Para os streams não tomarem todas
+    as threads, cada worker aceita no máximo SSE_MAX_STREAMS = WEB_THREADS (ou
+    WORKER_CONNECTIONS) − WEB_API_RESERVE. Acima disso o servidor responde com um
+    `retry:` com jitter e o EventSource volta mais tarde e pede um resync. Nos padrões
+    (2 × 128 threads, reserva de 32) são 192 streams por dyno, com 64 threads sempre
+    livres para a API. Um stream de cliente que sumiu só libera a vaga no próximo
+    keepalive (SSE_KEEPALIVE_SECONDS).
+
+Capacidade
+    Streams por dyno ≈ WEB_CONCURRENCY × SSE_MAX_STREAMS. Para mais que algumas
+    centenas de clientes ao vivo, use gevent (1-2 workers, WORKER_CONNECTIONS=1000).
+    Consultas simultâneas ao banco continuam limitadas a WEB_CONCURRENCY × DB_POOL_MAX.
+    Confira se isso cabe no limite de conexões do Supabase, e acompanhe a espera em
+    /api/db/pool.
+
+    Medição (bench/seed.py --alunos 1500 --equipe 60 --anos 2; bench/loadtest.py
+    --mix domingo --eventos --duracao 60 --aquecimento 10). Ambiente: 1 vCPU
+    compartilhada pelo Postgres 16 local, pelos 2 workers e pelo gerador de carga.
+    Os workers usaram ~78% da CPU, então as latências abaixo são limitadas por essa
+    CPU e não valem como números de dyno; o que a medição mostra é o comportamento
+    das threads.
+
+                                        streams   req/s    p50     p95     timeouts
+      2 × 32 threads, sem limite, 100 VU  64/100       0      -       -    200 de 200
+      2 × 128 threads, limite 96, 100 VU 100/100      82   328 ms  2,8 s    0
+      idem, 300 VU (--pausa 3)           192/300      50   3,1 s   7,5 s    0
+
+    Na configuração antiga, os 64 streams ocuparam todas as threads e nenhuma
+    requisição da API (check-ins inclusive) foi atendida antes do timeout do cliente,
+    de 60 s. Numa execução anterior, com 60 streams, 72 requisições esperaram até o
+    timeout. Na nova, os streams acima do limite receberam retry (428 recusas em
+    60 s). Os únicos erros foram 2 esperas pelo pool (DB_POOL_TIMEOUT) no pico.
+    Repita a medição no dyno real antes de mexer nos números.
+"""
+import os
+import shutil
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+worker_class = os.getenv("WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("WEB_THREADS", "128"))
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "1000"))
+# threads (gthread) ou conexões (gevent) que os streams SSE nunca ocupam
+api_reserve = int(os.getenv("WEB_API_RESERVE", "32"))
+
+# gthread/gevent medem o timeout pelo heartbeat do worker, não pela duração da
+# requisição: streams SSE longos não derrubam o worker
+timeout = int(os.getenv("WEB_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("WEB_KEEPALIVE", "5"))
+
+# reciclar workers de tempos em tempos (0 = nunca)
+max_requests = int(os.getenv("WEB_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("WEB_MAX_REQUESTS_JITTER", "0"))
+
+# sem preload: pool, listener de sinais e executor de miniaturas nascem em cada worker
+preload_app = False
+
+accesslog = "-" if os.getenv("WEB_ACCESS_LOG", "0") == "1" else None
+errorlog = "-"
+
+# limite de streams /api/eventos por worker, lido pelo server.py; acima dele o cliente
+# recebe um retry e volta mais tarde, e as threads da reserva ficam livres para a API
+slots = worker_connections if worker_class == "gevent" else threads
+os.environ.setdefault("SSE_MAX_STREAMS", str(max(1, slots - api_reserve)))
+
+# métricas Prometheus e consultas lentas: cada worker grava em arquivos nesse diretório
+# e o /api/metrics e o /api/db/lentas juntam todos (definido aqui para valer antes do
+# import do app)
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "kid-metrics"))
+
+
+def on_starting(server):
+    # arquivos de uma execução anterior contariam em dobro
+    d = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(d, ignore_errors=True)
+    os.makedirs(d, exist_ok=True)
+
+
+def child_exit(server, worker):
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
+
+
+if worker_class == "gevent":
+    def post_fork(server, worker):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        server.log.info("psycopg2 em modo cooperativo (psycogreen)")
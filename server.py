@@ -1,19 +1,377 @@
 import os
+import re
+import sys
+import time
+import io
+import csv
+import json
+import queue
+import select
+import base64
+import unicodedata
+import hashlib
+import random
+import threading
+import gzip
+import urllib.error
+import urllib.request
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple, deque
+from contextlib import contextmanager
 from functools import wraps
-from datetime import datetime
+from datetime import datetime, date
 
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, Response, request, jsonify, render_template, send_from_directory, send_file, redirect, abort, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.errors
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor, execute_values
 
-from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from itsdangerous import URLSafeSerializer, URLSafeTimedSerializer, BadSignature, SignatureExpired
+
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:  # sem Pillow as variantes não são geradas e servimos o original
+    Image = None
+
+try:
+    import orjson
+except ImportError:  # sem orjson cai no json da stdlib, com o mesmo formato de datas
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # sem brotli só gzip
+    brotli = None
+
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Histogram, CollectorRegistry, multiprocess
+except ImportError:  # sem prometheus_client o /api/metrics responde 503; X-DB-Queries continua
+    prometheus_client = None
 
 # ---------------- App ----------------
 app = Flask(__name__, template_folder="templates", static_folder="static")
 CORS(app)
 
+
+# ---------------- JSON / compressão ----------------
+def json_default(value):
+    # datas em ISO 8601 (o orjson já faz isso sozinho para datetime/date)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"{type(value).__name__} não é serializável em JSON")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify com orjson: linhas do RealDictCursor vão direto, com datas em ISO 8601."""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.dumps(obj, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+        kwargs.setdefault("default", json_default)
+        kwargs.setdefault("ensure_ascii", False)
+        return json.dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if orjson is not None:
+            body = orjson.dumps(obj, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+        else:
+            body = json.dumps(obj, default=json_default, ensure_ascii=False, separators=(",", ":"))
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+app.json = FastJSONProvider(app)
+
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+COMPRESS_MIMETYPES = {
+    "application/json", "text/html", "text/css", "text/plain", "text/csv",
+    "text/javascript", "application/javascript", "application/manifest+json", "image/svg+xml",
+}
+
+
+@app.after_request
+def compress_response(resp):
+    """gzip/brotli conforme Accept-Encoding, para respostas em memória acima do limite"""
+    if (
+        request.method == "HEAD"
+        or resp.status_code < 200 or resp.status_code in (204, 304)
+        or resp.direct_passthrough or resp.is_streamed
+        or "Content-Encoding" in resp.headers
+        or resp.mimetype not in COMPRESS_MIMETYPES
+    ):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    if (resp.content_length or 0) < COMPRESS_MIN_BYTES:
+        return resp
+
+    encoding = request.accept_encodings.best_match(["br", "gzip"] if brotli else ["gzip"])
+    if not encoding:
+        return resp
+    data = resp.get_data()
+    if encoding == "br":
+        resp.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    else:
+        resp.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL))
+    resp.headers["Content-Encoding"] = encoding
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)
+    return resp
+
+
+# ---------------- Métricas (Prometheus) ----------------
+# Sob o gunicorn, PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py) faz cada worker gravar as
+# métricas em arquivos e o /api/metrics soma todos; sem a variável vale o próprio processo.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_OPS = {"select", "insert", "update", "delete", "with", "copy"}
+
+if prometheus_client is not None:
+    HTTP_LATENCY = Histogram(
+        "kid_http_request_seconds", "Latência das requisições até o início da resposta",
+        ["endpoint", "method", "status"], buckets=LATENCY_BUCKETS,
+    )
+    HTTP_BYTES = Histogram(
+        "kid_http_response_bytes", "Tamanho do corpo das respostas (antes da compressão)",
+        ["endpoint"], buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+    )
+    DB_QUERIES = Histogram(
+        "kid_db_queries_per_request", "Consultas ao banco por requisição",
+        ["endpoint"], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55),
+    )
+    DB_REQUEST_TIME = Histogram(
+        "kid_db_seconds_per_request", "Tempo total em consultas por requisição",
+        ["endpoint"], buckets=LATENCY_BUCKETS,
+    )
+    DB_QUERY_TIME = Histogram("kid_db_query_seconds", "Duração de cada execute", ["op"], buckets=LATENCY_BUCKETS)
+    DB_ACQUIRE_TIME = Histogram("kid_db_pool_acquire_seconds", "Espera por uma conexão do pool", buckets=LATENCY_BUCKETS)
+    DB_POOL_TIMEOUTS = Counter("kid_db_pool_timeouts_total", "Requisições que desistiram de esperar o pool")
+
+
+def query_op(query):
+    if isinstance(query, bytes):
+        query = query[:32].decode("utf-8", "replace")
+    elif not isinstance(query, str):
+        return "other"
+    words = query[:32].split(None, 1)
+    op = words[0].lower() if words else ""
+    return op if op in QUERY_OPS else "other"
+
+
+def record_query(query, elapsed):
+    if has_request_context():
+        g.db_queries = g.get("db_queries", 0) + 1
+        g.db_seconds = g.get("db_seconds", 0.0) + elapsed
+    if prometheus_client is not None:
+        DB_QUERY_TIME.labels(query_op(query)).observe(elapsed)
+
+
+def record_acquire(elapsed):
+    if has_request_context():
+        g.db_wait_seconds = g.get("db_wait_seconds", 0.0) + elapsed
+    if prometheus_client is not None:
+        DB_ACQUIRE_TIME.observe(elapsed)
+
+
+# ---------------- Consultas lentas ----------------
+# Acima de SLOW_QUERY_MS a consulta vai para um buffer circular por worker (GET /api/db/lentas).
+# Uma fração SLOW_QUERY_EXPLAIN_RATE dos SELECTs lentos é reexecutada com EXPLAIN ANALYZE.
+# Sob o gunicorn cada worker também grava o buffer em PROMETHEUS_MULTIPROC_DIR e o
+# /api/db/lentas junta os de todos (inclusive de workers já reciclados, até o restart).
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "250"))  # 0 desliga
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", "0.02"))
+SLOW_QUERY_BUFFER = int(os.getenv("SLOW_QUERY_BUFFER", "200"))
+SLOW_QUERY_SQL_MAX = 4000
+# funções com efeito colateral: reexecutar com ANALYZE repetiria o efeito
+EXPLAIN_UNSAFE_RE = re.compile(r"pg_notify|pg_advisory|nextval|setval|for\s+update|for\s+share", re.I)
+
+_slow_queries = deque(maxlen=SLOW_QUERY_BUFFER)
+_slow_queries_lock = threading.Lock()
+
+
+def normalize_sql(query):
+    """SQL sem literais (strings e números viram ?) e com espaços colapsados."""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    elif not isinstance(query, str):
+        query = str(query)
+    q = re.sub(r"'(?:[^']|'')*'", "'?'", query)
+    q = re.sub(r"\b\d+(?:\.\d+)?\b", "?", q)
+    return re.sub(r"\s+", " ", q).strip()[:SLOW_QUERY_SQL_MAX]
+
+
+def redact_params(vars):
+    """Só o tipo (e tamanho) de cada parâmetro: nada de dados pessoais no log."""
+    def kind(v):
+        if v is None:
+            return None
+        if isinstance(v, (list, tuple)):
+            return f"{type(v).__name__}[{len(v)}]"
+        if isinstance(v, (str, bytes)):
+            return f"{type(v).__name__}({len(v)})"
+        return type(v).__name__
+
+    if vars is None:
+        return None
+    if isinstance(vars, dict):
+        return {k: kind(v) for k, v in vars.items()}
+    return [kind(v) for v in vars]
+
+
+def explain_query(cur, query, vars):
+    """EXPLAIN (ANALYZE, BUFFERS) na mesma transação, isolado num savepoint."""
+    conn = cur.connection
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as ec:
+        if not conn.autocommit:
+            ec.execute("SAVEPOINT explain_lenta")
+        try:
+            prefix = "EXPLAIN (ANALYZE, BUFFERS) "
+            ec.execute(prefix.encode() + query if isinstance(query, bytes) else prefix + query, vars)
+            plano = "\n".join(r[0] for r in ec.fetchall())
+        except psycopg2.Error as e:
+            if not conn.autocommit:
+                ec.execute("ROLLBACK TO SAVEPOINT explain_lenta")
+            return f"(EXPLAIN falhou: {str(e).strip()})"
+        if not conn.autocommit:
+            ec.execute("RELEASE SAVEPOINT explain_lenta")
+        return plano
+
+
+def record_slow_query(cur, query, vars, elapsed, can_explain):
+    sql = normalize_sql(query)
+    plano = None
+    if (
+        can_explain and not cur.name
+        and query_op(query) in ("select", "with")
+        and not EXPLAIN_UNSAFE_RE.search(sql)
+        and not re.search(r"\b(insert|update|delete)\b", sql, re.I)
+        and random.random() < SLOW_QUERY_EXPLAIN_RATE
+    ):
+        try:
+            plano = explain_query(cur, query, vars)
+        except Exception as e:
+            plano = f"(EXPLAIN falhou: {e})"
+
+    if has_request_context():
+        rota, metodo = request.endpoint or request.path, request.method
+    else:
+        rota, metodo = threading.current_thread().name, None
+    entry = {
+        "em": datetime.utcnow(),
+        "ms": round(elapsed * 1000, 1),
+        "rota": rota,
+        "metodo": metodo,
+        "sql": sql,
+        "params": redact_params(vars),
+        "linhas": cur.rowcount,
+        "plano": plano,
+        "pid": os.getpid(),
+    }
+    with _slow_queries_lock:
+        _slow_queries.append(entry)
+        save_slow_queries()
+    print(f"🐢 Consulta lenta ({entry['ms']:.0f} ms) em {rota}: {sql[:200]}")
+
+
+def save_slow_queries():
+    """Regrava o buffer deste worker no diretório compartilhado (chamar com o lock)."""
+    d = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not d:
+        return
+    path = os.path.join(d, f"lentas_{os.getpid()}.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(list(_slow_queries), f, default=json_default, ensure_ascii=False)
+    # troca atômica: quem lê nunca vê o arquivo pela metade
+    os.replace(path + ".tmp", path)
+
+
+def load_slow_queries():
+    """Consultas lentas de todos os workers; sem o diretório compartilhado, só as deste processo."""
+    d = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not d:
+        with _slow_queries_lock:
+            return list(_slow_queries)
+    entries = []
+    try:
+        nomes = os.listdir(d)
+    except OSError:
+        nomes = []
+    for nome in nomes:
+        if not (nome.startswith("lentas_") and nome.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(d, nome), encoding="utf-8") as f:
+                entries.extend(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return entries
+
+
+class InstrumentedCursor(RealDictCursor):
+    """RealDictCursor que conta e cronometra cada comando (por requisição e no Prometheus)."""
+
+    def _measured(self, fn, query, vars, can_explain=False):
+        started = time.perf_counter()
+        ok = False
+        try:
+            result = fn()
+            ok = True
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            record_query(query, elapsed)
+            if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+                try:
+                    record_slow_query(self, query, vars, elapsed, can_explain and ok)
+                except Exception as e:
+                    print("Erro ao registrar consulta lenta:", str(e))
+
+    def execute(self, query, vars=None):
+        return self._measured(lambda: super(InstrumentedCursor, self).execute(query, vars), query, vars, True)
+
+    def executemany(self, query, vars_list):
+        return self._measured(lambda: super(InstrumentedCursor, self).executemany(query, vars_list), query, None)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._measured(lambda: super(InstrumentedCursor, self).copy_expert(sql, file, size), sql, None)
+
+
+@app.before_request
+def _metrics_start():
+    g.started_at = time.perf_counter()
+
+
+@app.after_request
+def _metrics_record(resp):
+    started = g.get("started_at")
+    if started is None:
+        return resp
+    elapsed = time.perf_counter() - started
+    queries = g.get("db_queries", 0)
+    resp.headers["X-DB-Queries"] = str(queries)
+    server_timing(resp, "sql", g.get("db_seconds", 0.0) * 1000)
+    server_timing(resp, "pool", g.get("db_wait_seconds", 0.0) * 1000)
+
+    if prometheus_client is not None and request.endpoint != "metrics":
+        endpoint = request.endpoint or "nao_encontrado"
+        HTTP_LATENCY.labels(endpoint, request.method, str(resp.status_code)).observe(elapsed)
+        if resp.content_length is not None:
+            HTTP_BYTES.labels(endpoint).observe(resp.content_length)
+        DB_QUERIES.labels(endpoint).observe(queries)
+        DB_REQUEST_TIME.labels(endpoint).observe(g.get("db_seconds", 0.0))
+    return resp
+
+
 # ---------------- DB ----------------
 DB_CONFIG = {
     "host": os.getenv("DB_HOST", "db.phqsoznnrrcjyebzyfht.supabase.co"),
@@ -24,14 +382,219 @@ DB_CONFIG = {
     "sslmode": os.getenv("DB_SSLMODE", "require"),
 }
 
+# Pool por processo: cada worker do gunicorn abre o seu depois do fork.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+# conexões ociosas há mais que isso recebem um "SELECT 1" antes de voltar ao uso
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Pool de conexões thread-safe, com checagem antes do reuso e tempo de vida máximo."""
+
+    def __init__(self, minconn, maxconn, timeout, max_lifetime, ping_after):
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = []      # [(conn, criada_em, usada_em)]
+        self._born = {}      # id(conn) -> criada_em
+        self._size = 0
+        self._stats = {
+            "acquired": 0,
+            "waited": 0,
+            "timeouts": 0,
+            "wait_total_ms": 0.0,
+            "wait_max_ms": 0.0,
+            "opened": 0,
+            "recycled": 0,
+            "discarded": 0,
+        }
+        for _ in range(self.minconn):
+            try:
+                conn = self._connect()
+            except Exception as e:
+                print("⚠️ Falha ao abrir conexão inicial do pool:", e)
+                break
+            now = time.monotonic()
+            self._idle.append((conn, now, now))
+            self._size += 1
+
+    def _connect(self):
+        conn = psycopg2.connect(**DB_CONFIG, cursor_factory=InstrumentedCursor)
+        self._born[id(conn)] = time.monotonic()
+        self._stats["opened"] += 1
+        return conn
+
+    def _close(self, conn):
+        self._born.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _usable(self, conn, born, last_used):
+        now = time.monotonic()
+        if conn.closed:
+            return False
+        if self.max_lifetime and now - born > self.max_lifetime:
+            self._stats["recycled"] += 1
+            return False
+        if self.ping_after and now - last_used > self.ping_after:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except Exception:
+                return False
+        return True
+
+    def acquire(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout("Pool de conexões esgotado")
+                    waited = True
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, born, last_used = self._idle.pop()
+                else:
+                    conn = None
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._usable(conn, born, last_used):
+                self._close(conn)
+                with self._cond:
+                    self._size -= 1
+                    self._stats["discarded"] += 1
+                    self._cond.notify()
+                continue
+
+            wait_ms = (time.monotonic() - started) * 1000
+            with self._cond:
+                self._stats["acquired"] += 1
+                self._stats["wait_total_ms"] += wait_ms
+                if waited:
+                    self._stats["waited"] += 1
+                if wait_ms > self._stats["wait_max_ms"]:
+                    self._stats["wait_max_ms"] = wait_ms
+            return conn
+
+    def release(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        if discard or conn.closed:
+            self._close(conn)
+            with self._cond:
+                self._size -= 1
+                self._stats["discarded"] += 1
+                self._cond.notify()
+            return
+
+        born = self._born.get(id(conn), time.monotonic())
+        with self._cond:
+            self._idle.append((conn, born, time.monotonic()))
+            self._cond.notify()
+
+    def snapshot(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "pid": self.pid,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min": self.minconn,
+                "max": self.maxconn,
+            })
+        acquired = stats["acquired"] or 1
+        stats["wait_avg_ms"] = round(stats["wait_total_ms"] / acquired, 3)
+        stats["wait_total_ms"] = round(stats["wait_total_ms"], 3)
+        stats["wait_max_ms"] = round(stats["wait_max_ms"], 3)
+        return stats
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Pool do processo atual; recria depois de um fork (não reaproveita sockets do pai)."""
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+                                   DB_POOL_MAX_LIFETIME, DB_POOL_PING_AFTER)
+        return _pool
+
+
+@contextmanager
+def db():
+    """Empresta uma conexão do pool; o que não foi commitado sofre rollback na devolução."""
+    pool = get_pool()
+    started = time.perf_counter()
+    try:
+        conn = pool.acquire()
+    except PoolTimeout:
+        if prometheus_client is not None:
+            DB_POOL_TIMEOUTS.inc()
+        raise
+    finally:
+        record_acquire(time.perf_counter() - started)
+    discard = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        discard = True
+        raise
+    finally:
+        pool.release(conn, discard=discard)
+
 # ---------------- Auth ----------------
 SECRET_KEY = os.getenv("SECRET_KEY", "ieq-central-2026-super-secret")
 TOKEN_MAX_AGE_SECONDS = 60 * 60 * 24 * 14
 serializer = URLSafeTimedSerializer(SECRET_KEY)
+# o EventSource só autentica pela URL, que acaba nos logs do router: o stream usa um
+# token próprio, curto e que não serve para a API
+STREAM_TOKEN_MAX_AGE_SECONDS = int(os.getenv("STREAM_TOKEN_MAX_AGE_SECONDS", "60"))
+stream_serializer = URLSafeTimedSerializer(SECRET_KEY, salt="eventos")
 
 
-def db():
-    return psycopg2.connect(**DB_CONFIG, cursor_factory=RealDictCursor)
 
 
 def api_error(message, status=500, details=None):
@@ -74,16 +637,942 @@ def require_auth(fn):
     return wrapper
 
 
-def is_admin():
+def server_timing(resp, name, ms):
+    """Acrescenta uma métrica ao cabeçalho Server-Timing (visível no DevTools)."""
+    entry = f"{name};dur={ms:.2f}"
+    current = resp.headers.get("Server-Timing")
+    resp.headers["Server-Timing"] = f"{current}, {entry}" if current else entry
+    return resp
+
+
+def is_admin(cur=None):
+    """Papel atual do usuário (diretório em cache), não o gravado no token na hora do login."""
     u = getattr(request, "user", None) or {}
-    return u.get("role") == "admin"
+    try:
+        atual = user_directory.get(u.get("id"), cur)
+    except Exception as e:
+        print("Erro ao consultar papel do usuário:", str(e))
+        atual = u
+    return (atual or {}).get("role") == "admin"
+
+
+# ---------------- GET condicional (ETag) ----------------
+# versões por tabela mantidas pelo trigger versoes_bump (migração 9)
+def table_versions(tabelas):
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT tabela, versao FROM versoes WHERE tabela = ANY(%s)", (list(tabelas),))
+        found = {r["tabela"]: r["versao"] for r in cur.fetchall()}
+    return [found.get(t, 0) for t in tabelas]
+
+
+def conditional(*tabelas):
+    """ETag derivado das versões das tabelas lidas pela rota.
+
+    Com If-None-Match igual responde 304 sem rodar a query principal. O ETag inclui o
+    usuário e a URL completa (filtros, cursor), então respostas por usuário não se misturam.
+    Usar abaixo de @require_auth.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            try:
+                versions = table_versions(tabelas)
+            except Exception as e:
+                print("Erro ao ler versões:", str(e))
+                return fn(*args, **kwargs)
+
+            uid = (getattr(request, "user", None) or {}).get("id")
+            raw = f"{uid}|{request.full_path}|{','.join(map(str, versions))}"
+            etag = hashlib.sha1(raw.encode()).hexdigest()[:24]
+
+            if request.if_none_match.contains_weak(etag):
+                resp = Response(status=304)
+            else:
+                resp = app.make_response(fn(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+            resp.set_etag(etag, weak=True)
+            resp.headers["Cache-Control"] = "private, no-cache"
+            resp.vary.add("Authorization")
+            return resp
+        return wrapper
+    return decorator
+
+
+# ---------------- Paginação (keyset) ----------------
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "500"))
+cursor_serializer = URLSafeSerializer(SECRET_KEY, salt="cursor")
+
+# chaves de ordenação estáveis de cada listagem (expressões SQL, última sempre o id)
+EPOCH = "TIMESTAMP '1970-01-01'"
+ALUNOS_KEYS = ("COALESCE(nome, '')", "id")
+USUARIOS_KEYS = ("COALESCE(nome, '')", "id")
+AVISOS_KEYS = ("fixado", f"COALESCE(data_criacao, {EPOCH})", "id")
+HISTORICO_KEYS = (f"COALESCE(a.data_aula, {EPOCH})", "a.id")
+COMENTARIOS_KEYS = (f"COALESCE(created_at, {EPOCH})", "id")
+
+Page = namedtuple("Page", "kind keys desc after limit envelope")
+
+
+def read_page(kind, keys, legacy_limit, desc=False):
+    """Lê ?cursor= e ?limit= do request.
+
+    Sem nenhum dos dois o cliente é antigo: mantém o limite e o formato de resposta de antes.
+    Levanta ValueError para cursor ou limite inválidos.
+    """
+    raw_cursor = request.args.get("cursor")
+    raw_limit = request.args.get("limit")
+    envelope = raw_cursor is not None or raw_limit is not None
+
+    if raw_limit:
+        try:
+            limit = int(raw_limit)
+        except ValueError:
+            raise ValueError("limit inválido")
+    else:
+        limit = PAGE_SIZE_DEFAULT if envelope else legacy_limit
+    limit = max(1, min(limit, PAGE_SIZE_MAX))
+
+    after = None
+    if raw_cursor:
+        try:
+            data = cursor_serializer.loads(raw_cursor)
+        except BadSignature:
+            raise ValueError("cursor inválido")
+        if not isinstance(data, dict) or data.get("k") != kind or len(data.get("v") or []) != len(keys):
+            raise ValueError("cursor inválido")
+        after = data["v"]
+
+    return Page(kind, keys, desc, after, limit, envelope)
+
+
+def page_sql(page):
+    """Retorna (colunas extras, condição, parâmetros, ORDER BY) para a página pedida."""
+    columns = ", ".join(f"{k} AS _k{i}" for i, k in enumerate(page.keys))
+    direction = "DESC" if page.desc else "ASC"
+    order = ", ".join(f"{k} {direction}" for k in page.keys)
+    if page.after is None:
+        return columns, "TRUE", [], order
+    op = "<" if page.desc else ">"
+    placeholders = ", ".join(["%s"] * len(page.keys))
+    return columns, f"({', '.join(page.keys)}) {op} ({placeholders})", list(page.after), order
+
+
+def finish_page(page, rows):
+    """Corta a linha extra buscada (LIMIT n+1) e monta o próximo cursor."""
+    next_cursor = None
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        last = rows[-1]
+        values = []
+        for i in range(len(page.keys)):
+            v = last[f"_k{i}"]
+            values.append(v.isoformat() if isinstance(v, datetime) else v)
+        next_cursor = cursor_serializer.dumps({"k": page.kind, "v": values})
+    for r in rows:
+        for i in range(len(page.keys)):
+            r.pop(f"_k{i}", None)
+    return rows, next_cursor
+
+
+def page_response(page, rows, next_cursor):
+    if page.envelope:
+        return jsonify({"ok": True, "items": rows, "next_cursor": next_cursor})
+    resp = jsonify(rows)
+    if next_cursor:
+        resp.headers["X-Next-Cursor"] = next_cursor
+    return resp
+
+
+# ---------------- Busca (pg_trgm) ----------------
+def search_sql(q):
+    """Condição, expressão de ranking e parâmetros da busca na coluna normalizada `busca`.
+
+    `busca` guarda nome(s) sem acento e em minúsculas e tem índice GIN de trigramas, que
+    atende tanto o LIKE por substring quanto a semelhança por palavra (<%).
+    """
+    like = "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    cond = "(busca LIKE busca_normalizada(%s) OR busca_normalizada(%s) <%% busca)"
+    rank = "word_similarity(busca_normalizada(%s), busca)"
+    return cond, rank, [like, q, q]
+
+
+# ---------------- Mídia (blobs por hash) ----------------
+# MEDIA_BACKEND=local só para desenvolvimento: no Heroku o disco do dyno é efêmero
+MEDIA_BACKEND = os.getenv("MEDIA_BACKEND", "supabase" if os.getenv("SUPABASE_URL") else "local")
+MEDIA_DIR = os.getenv("MEDIA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "media"))
+MEDIA_BUCKET = os.getenv("MEDIA_BUCKET", "media")
+MEDIA_TIMEOUT = float(os.getenv("MEDIA_TIMEOUT", "15"))
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(10 * 1024 * 1024)))
+MEDIA_CACHE_SECONDS = 60 * 60 * 24 * 365
+MEDIA_KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+MEDIA_URL_RE = re.compile(r"^/media/([0-9a-f]{64})(?:/[a-z]+)?$")
+
+
+class LocalBlobStore:
+    """Guarda blobs no disco local, um arquivo por chave (sha256 do conteúdo)."""
+
+    durable = False
+
+    def __init__(self, root):
+        self.root = root
+
+    @classmethod
+    def from_env(cls):
+        return cls(MEDIA_DIR)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def open(self, key):
+        return open(self.path(key), "rb")
+
+    def put(self, data, key=None):
+        key = key or hashlib.sha256(data).hexdigest()
+        dest = self.path(key)
+        if os.path.isfile(dest):
+            return key
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, dest)
+        return key
+
+
+class SupabaseBlobStore:
+    """Guarda blobs num bucket do Supabase Storage, pela API REST.
+
+    O bucket pode (e deve) ser privado: o /media lê com a service key e serve com cache
+    imutável. Como a chave é o hash do conteúdo, um blob visto uma vez existe para sempre
+    e o worker guarda isso em memória para não repetir o HEAD.
+    """
+
+    durable = True
+    KNOWN_MAX = 20000
+
+    def __init__(self, url, service_key, bucket):
+        if not url or not service_key:
+            raise RuntimeError("MEDIA_BACKEND=supabase precisa de SUPABASE_URL e SUPABASE_SERVICE_KEY")
+        self.base = f"{url.rstrip('/')}/storage/v1/object"
+        self.bucket = bucket
+        self.headers = {"Authorization": f"Bearer {service_key}", "apikey": service_key}
+        self._known = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_KEY"), MEDIA_BUCKET)
+
+    def _url(self, key, rota=""):
+        return f"{self.base}/{rota}{self.bucket}/{key[:2]}/{key}"
+
+    def _request(self, method, url, data=None, headers=None):
+        req = urllib.request.Request(url, data=data, method=method, headers={**self.headers, **(headers or {})})
+        return urllib.request.urlopen(req, timeout=MEDIA_TIMEOUT)
+
+    def _remember(self, key):
+        with self._lock:
+            if len(self._known) >= self.KNOWN_MAX:
+                self._known.clear()
+            self._known.add(key)
+
+    def exists(self, key):
+        if key in self._known:
+            return True
+        try:
+            with self._request("HEAD", self._url(key, "authenticated/")):
+                pass
+        except urllib.error.HTTPError as e:
+            # o Storage responde 400 "Object not found" em algumas versões
+            if e.code in (400, 404):
+                return False
+            raise
+        self._remember(key)
+        return True
+
+    def open(self, key):
+        with self._request("GET", self._url(key, "authenticated/")) as resp:
+            return io.BytesIO(resp.read())
+
+    def put(self, data, key=None):
+        key = key or hashlib.sha256(data).hexdigest()
+        if key in self._known:
+            return key
+        # upsert: o conteúdo de uma chave é sempre o mesmo, regravar não muda nada
+        headers = {"Content-Type": sniff_mimetype(data[:12]), "x-upsert": "true"}
+        with self._request("POST", self._url(key), data=data, headers=headers):
+            pass
+        self._remember(key)
+        return key
+
+
+BLOB_BACKENDS = {"local": LocalBlobStore, "supabase": SupabaseBlobStore}
+
+
+def make_blob_store():
+    backend = BLOB_BACKENDS.get(MEDIA_BACKEND)
+    if backend is None:
+        raise RuntimeError(f"MEDIA_BACKEND desconhecido: {MEDIA_BACKEND}")
+    store = backend.from_env()
+    if not store.durable and os.getenv("DYNO"):
+        print("⚠️ MEDIA_BACKEND=local num dyno do Heroku: as imagens somem no próximo deploy e não "
+              "aparecem nos outros dynos. Configure SUPABASE_URL e SUPABASE_SERVICE_KEY.")
+    return store
+
+
+blobs = make_blob_store()
+
+
+def sniff_mimetype(head):
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def media_url(key):
+    return f"/media/{key}"
+
+
+def variant_url(url, variant):
+    """URL da variante redimensionada de uma imagem /media; outros valores passam intactos."""
+    m = MEDIA_URL_RE.match(url or "")
+    if not m:
+        return url
+    return f"/media/{m.group(1)}/{variant}"
+
+
+def with_variant(rows, column, variant):
+    for r in rows:
+        if r.get(column):
+            r[column] = variant_url(r[column], variant)
+    return rows
+
+
+def store_image(value):
+    """Converte a imagem recebida (base64, data URI ou URL /media já existente) em URL /media/<hash>.
+
+    Levanta ValueError se o conteúdo não for base64 válido ou passar do limite.
+    """
+    value = (value or "").strip()
+    if not value:
+        return None
+
+    m = MEDIA_URL_RE.match(value)
+    if m:
+        return media_url(m.group(1))
+
+    if value.startswith("data:") and "," in value:
+        value = value.split(",", 1)[1]
+    try:
+        data = base64.b64decode(value, validate=True)
+    except (ValueError, TypeError):
+        raise ValueError("Imagem inválida")
+    if not data:
+        return None
+    if len(data) > MEDIA_MAX_BYTES:
+        raise ValueError("Imagem muito grande")
+
+    key = blobs.put(data)
+    enqueue_variants(key)
+    return media_url(key)
+
+
+# ---------------- Miniaturas ----------------
+# lado maior de cada variante, em pixels
+IMAGE_VARIANTS = {"avatar": 128, "card": 640, "full": 1600}
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "78"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_QUEUE_MAX = int(os.getenv("IMAGE_QUEUE_MAX", "32"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "WEBP").upper()
+
+_image_executor = None
+_image_executor_pid = None
+_image_slots = threading.BoundedSemaphore(IMAGE_QUEUE_MAX)
+_image_lock = threading.Lock()
+
+
+def variant_key(key, variant):
+    return f"{key}.{variant}"
+
+
+def _image_format():
+    if IMAGE_FORMAT == "WEBP" and not pil_features.check("webp"):
+        return "JPEG"
+    return IMAGE_FORMAT
+
+
+def render_variants(key):
+    """Gera as variantes que ainda não existem para o blob `key`."""
+    if Image is None:
+        return
+    pendentes = [v for v in IMAGE_VARIANTS if not blobs.exists(variant_key(key, v))]
+    if not pendentes:
+        return
+
+    fmt = _image_format()
+    with blobs.open(key) as f, Image.open(f) as original:
+        original = ImageOps.exif_transpose(original)
+        if fmt == "JPEG" or original.mode not in ("RGB", "RGBA"):
+            original = original.convert("RGB" if fmt == "JPEG" else "RGBA")
+        for variant in pendentes:
+            lado = IMAGE_VARIANTS[variant]
+            img = original.copy()
+            img.thumbnail((lado, lado), Image.LANCZOS)
+            out = io.BytesIO()
+            if fmt == "JPEG":
+                img.save(out, "JPEG", quality=IMAGE_QUALITY, optimize=True, progressive=True)
+            else:
+                img.save(out, fmt, quality=IMAGE_QUALITY, method=4)
+            blobs.put(out.getvalue(), key=variant_key(key, variant))
+
+
+def _render_variants_job(key):
+    try:
+        render_variants(key)
+    except Exception as e:
+        print(f"⚠️ Falha ao gerar miniaturas de {key}:", e)
+    finally:
+        _image_slots.release()
+
+
+def _get_image_executor():
+    global _image_executor, _image_executor_pid
+    if _image_executor is None or _image_executor_pid != os.getpid():
+        with _image_lock:
+            if _image_executor is None or _image_executor_pid != os.getpid():
+                _image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="miniaturas")
+                _image_executor_pid = os.getpid()
+    return _image_executor
+
+
+def enqueue_variants(key):
+    """Agenda a geração fora da thread do request; com a fila cheia fica para o primeiro acesso."""
+    if Image is None:
+        return False
+    if not _image_slots.acquire(blocking=False):
+        return False
+    try:
+        _get_image_executor().submit(_render_variants_job, key)
+    except Exception:
+        _image_slots.release()
+        return False
+    return True
+
+
+# ---------------- Sinais entre workers (LISTEN/NOTIFY) ----------------
+# Cada worker mantém uma conexão dedicada em LISTEN; os handlers publicam com pg_notify
+# dentro da própria transação, então o sinal só sai se o commit acontecer.
+SIGNAL_CHANNEL = os.getenv("SIGNAL_CHANNEL", "kid_sinais")
+SIGNAL_KEEPALIVE_SECONDS = 30
+
+_signal_handlers = {}
+_listener = {"pid": None, "connected": False}
+_listener_lock = threading.Lock()
+
+
+def on_signal(kind):
+    """Registra um handler para um tipo de sinal; "reset" é disparado a cada (re)conexão."""
+    def deco(fn):
+        _signal_handlers.setdefault(kind, []).append(fn)
+        return fn
+    return deco
+
+
+def notify(cur, kind, **data):
+    payload = app.json.dumps({"t": kind, "pid": os.getpid(), **data})
+    cur.execute("SELECT pg_notify(%s, %s)", (SIGNAL_CHANNEL, payload))
+
+
+def dispatch_signal(kind, data):
+    for fn in _signal_handlers.get(kind, []):
+        try:
+            fn(data)
+        except Exception as e:
+            print(f"⚠️ Falha ao tratar sinal {kind}:", e)
+
+
+def _listen_loop():
+    backoff = 1
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**DB_CONFIG)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f'LISTEN "{SIGNAL_CHANNEL}"')
+            _listener["connected"] = True
+            backoff = 1
+            # sinais emitidos enquanto estávamos desconectados se perderam
+            dispatch_signal("reset", {})
+
+            while True:
+                if select.select([conn], [], [], SIGNAL_KEEPALIVE_SECONDS) == ([], [], []):
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    n = conn.notifies.pop(0)
+                    try:
+                        data = json.loads(n.payload)
+                    except ValueError:
+                        continue
+                    dispatch_signal(data.pop("t", ""), data)
+        except Exception as e:
+            print("⚠️ Conexão de sinais caiu:", e)
+        finally:
+            _listener["connected"] = False
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 30)
+
+
+def ensure_listener():
+    """Sobe a thread de LISTEN deste processo (uma vez por worker, depois do fork)."""
+    if _listener["pid"] == os.getpid():
+        return
+    with _listener_lock:
+        if _listener["pid"] == os.getpid():
+            return
+        _listener["connected"] = False
+        threading.Thread(target=_listen_loop, name="sinais", daemon=True).start()
+        _listener["pid"] = os.getpid()
+
+
+def listener_connected():
+    return _listener["pid"] == os.getpid() and _listener["connected"]
+
+
+def signal_from_self(data):
+    return data.get("pid") == os.getpid()
+
+
+# ---------------- Eventos em tempo real (SSE) ----------------
+# Os handlers publicam deltas pequenos via pg_notify; a conexão de LISTEN de cada worker
+# repassa para as filas dos clientes conectados em /api/eventos.
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "20"))
+SSE_MAX_SECONDS = float(os.getenv("SSE_MAX_SECONDS", "900"))
+SSE_QUEUE_MAX = int(os.getenv("SSE_QUEUE_MAX", "200"))
+# streams abertos por worker; no gthread cada um segura uma thread, então o
+# gunicorn.conf.py deixa uma reserva de threads para a API (0 = sem limite)
+SSE_MAX_STREAMS = int(os.getenv("SSE_MAX_STREAMS", "0"))
+# com o limite atingido o cliente tenta de novo nesse intervalo (ms, com jitter)
+SSE_BUSY_RETRY_MS = int(os.getenv("SSE_BUSY_RETRY_MS", "30000"))
+
+_sse_clients = set()
+_sse_lock = threading.Lock()
+_sse_seq = {"n": 0}
+
+
+def publish_event(cur, tipo, **dados):
+    """Publica um evento para os clientes SSE de todos os workers (sai no commit)."""
+    notify(cur, "evento", tipo=tipo, dados=dados)
+
+
+def sse_subscribe():
+    """Fila do novo cliente, ou None se o worker já está no limite de streams."""
+    q = queue.Queue(maxsize=SSE_QUEUE_MAX)
+    with _sse_lock:
+        if SSE_MAX_STREAMS and len(_sse_clients) >= SSE_MAX_STREAMS:
+            return None
+        _sse_clients.add(q)
+    return q
+
+
+def sse_unsubscribe(q):
+    with _sse_lock:
+        _sse_clients.discard(q)
+
+
+def sse_broadcast(tipo, dados):
+    with _sse_lock:
+        _sse_seq["n"] += 1
+        event = {"id": _sse_seq["n"], "tipo": tipo, "dados": dados}
+        clients = list(_sse_clients)
+    for q in clients:
+        try:
+            q.put_nowait(event)
+        except queue.Full:
+            # cliente lento: derruba a conexão, o EventSource reconecta e ressincroniza
+            sse_unsubscribe(q)
+            try:
+                q.get_nowait()
+                q.put_nowait(None)
+            except (queue.Empty, queue.Full):
+                pass
+
+
+@on_signal("evento")
+def _sse_on_evento(data):
+    sse_broadcast(data.get("tipo") or "evento", data.get("dados") or {})
+
+
+@on_signal("reset")
+def _sse_on_reset(data):
+    # eventos podem ter se perdido enquanto o LISTEN estava fora
+    sse_broadcast("resync", {})
+
+
+# ---------------- Aula ativa (cache por worker) ----------------
+AULA_ATIVA_MAX_AGE = float(os.getenv("AULA_ATIVA_MAX_AGE", "300"))
+AULA_ATIVA_FALLBACK_AGE = float(os.getenv("AULA_ATIVA_FALLBACK_AGE", "5"))
+
+_aula_ativa = {"row": None, "loaded_at": 0.0, "valid": False, "gen": 0}
+_aula_ativa_lock = threading.Lock()
+
 
+def invalidate_aula_ativa():
+    with _aula_ativa_lock:
+        _aula_ativa["valid"] = False
+        _aula_ativa["gen"] += 1
 
-# ---------------- Migration / Tables ----------------
-def ensure_tables():
-    conn = db()
-    cur = conn.cursor()
 
+def get_aula_ativa(cur=None):
+    """Aula aberta mais recente (ou None); só vai ao banco quando o cache do worker expirou.
+
+    Sem `cur`, empresta uma conexão do pool apenas se precisar consultar.
+    """
+    with _aula_ativa_lock:
+        age = time.monotonic() - _aula_ativa["loaded_at"]
+        fresh = _aula_ativa["valid"] and age < AULA_ATIVA_MAX_AGE
+        if fresh and not listener_connected() and age > AULA_ATIVA_FALLBACK_AGE:
+            fresh = False
+        if fresh:
+            row = _aula_ativa["row"]
+            return dict(row) if row else None
+        gen = _aula_ativa["gen"]
+
+    if cur is None:
+        with db() as conn, conn.cursor() as c:
+            return _load_aula_ativa(c, gen)
+    return _load_aula_ativa(cur, gen)
+
+
+def _load_aula_ativa(cur, gen):
+    cur.execute(
+        "SELECT id, data_aula, tema, professores, encerrada_em FROM aulas WHERE encerrada_em IS NULL ORDER BY data_aula DESC LIMIT 1"
+    )
+    row = cur.fetchone()
+
+    with _aula_ativa_lock:
+        # se chegou uma invalidação durante a consulta, o resultado pode já estar velho
+        if _aula_ativa["gen"] == gen:
+            _aula_ativa.update(row=dict(row) if row else None, loaded_at=time.monotonic(), valid=True)
+    return dict(row) if row else None
+
+
+@on_signal("aula_ativa")
+@on_signal("reset")
+def _aula_ativa_on_signal(data):
+    invalidate_aula_ativa()
+
+
+# ---------------- Diretório de usuários (cache por worker) ----------------
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+USER_CACHE_FALLBACK_TTL = float(os.getenv("USER_CACHE_FALLBACK_TTL", "15"))
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", "2000"))
+USER_FIELDS = "id, nome, usuario, role, telefone, email, foto"
+
+
+class UserDirectory:
+    """Linhas de `usuarios` por id, com TTL; invalidadas pelo sinal "usuario" em todos os workers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # uid -> (row ou None, loaded_at)
+        self._gen = 0
+
+    def invalidate(self, uid=None):
+        with self._lock:
+            if uid is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(uid, None)
+            self._gen += 1
+
+    def get(self, uid, cur=None):
+        """Cópia da linha do usuário (ou None se não existe). Sem `cur`, só empresta conexão na falta."""
+        if uid is None:
+            return None
+        ttl = USER_CACHE_TTL if listener_connected() else USER_CACHE_FALLBACK_TTL
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry and time.monotonic() - entry[1] < ttl:
+                return dict(entry[0]) if entry[0] else None
+            gen = self._gen
+
+        if cur is None:
+            with db() as conn, conn.cursor() as c:
+                return self._load(c, uid, gen)
+        return self._load(cur, uid, gen)
+
+    def _load(self, cur, uid, gen):
+        cur.execute(f"SELECT {USER_FIELDS} FROM usuarios WHERE id=%s", (uid,))
+        row = cur.fetchone()
+        row = dict(row) if row else None
+        with self._lock:
+            # invalidação durante a consulta: não guarda o que pode já estar velho
+            if self._gen == gen:
+                if len(self._entries) >= USER_CACHE_MAX:
+                    self._entries.pop(next(iter(self._entries)))
+                self._entries[uid] = (row, time.monotonic())
+        return dict(row) if row else None
+
+
+user_directory = UserDirectory()
+
+
+@on_signal("usuario")
+@on_signal("reset")
+def _usuario_on_signal(data):
+    # "reset" não traz id: limpa o diretório inteiro
+    user_directory.invalidate(data.get("id"))
+
+
+# ---------------- Sugestões de alunos (typeahead em memória) ----------------
+TYPEAHEAD_FIELDS = ("nome", "responsavel", "autorizado_retirar", "autorizado_2", "autorizado_3")
+# sem a conexão de sinais não dá para confiar no índice por muito tempo
+TYPEAHEAD_MAX_AGE = float(os.getenv("TYPEAHEAD_MAX_AGE", "3600"))
+TYPEAHEAD_FALLBACK_AGE = float(os.getenv("TYPEAHEAD_FALLBACK_AGE", "60"))
+
+
+def normalize_text(value):
+    value = unicodedata.normalize("NFKD", value or "")
+    return "".join(c for c in value if not unicodedata.combining(c)).lower()
+
+
+def text_tokens(value):
+    return re.findall(r"\w+", normalize_text(value))
+
+
+def token_grams(token):
+    # mesmo preenchimento do pg_trgm no início: os trigramas cobrem os prefixos do token
+    padded = "  " + token
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TypeaheadIndex:
+    """Índice de trigramas de prefixo sobre os nomes de alunos, responsáveis e autorizados."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.docs = {}
+        self.grams = {}
+        self.loaded_at = 0.0
+        self.ready = False
+        self.gen = 0
+
+    def _add(self, row):
+        nome_tokens = set(text_tokens(row.get("nome")))
+        tokens = set(nome_tokens)
+        for field in TYPEAHEAD_FIELDS[1:]:
+            tokens.update(text_tokens(row.get(field)))
+        doc = {f: row.get(f) for f in TYPEAHEAD_FIELDS}
+        doc["id"] = row["id"]
+        self.docs[row["id"]] = (doc, nome_tokens, tokens, normalize_text(row.get("nome")))
+        for t in tokens:
+            for gram in token_grams(t):
+                self.grams.setdefault(gram, set()).add(row["id"])
+
+    def _remove(self, aluno_id):
+        entry = self.docs.pop(aluno_id, None)
+        if not entry:
+            return
+        for t in entry[2]:
+            for gram in token_grams(t):
+                posting = self.grams.get(gram)
+                if posting is not None:
+                    posting.discard(aluno_id)
+                    if not posting:
+                        del self.grams[gram]
+
+    def generation(self):
+        with self.lock:
+            return self.gen
+
+    def load(self, rows, gen):
+        """Troca o índice inteiro; False se houve escrita depois da leitura de `rows`."""
+        with self.lock:
+            # upsert/remove no meio da recarga foram aplicados nos dicts antigos e
+            # `rows` pode ser de antes do commit deles: descarta
+            if self.gen != gen:
+                return False
+            self.docs = {}
+            self.grams = {}
+            for r in rows:
+                self._add(r)
+            self.loaded_at = time.monotonic()
+            self.ready = True
+            return True
+
+    def upsert(self, row):
+        with self.lock:
+            self._remove(row["id"])
+            self._add(row)
+            self.gen += 1
+
+    def remove(self, aluno_id):
+        with self.lock:
+            self._remove(aluno_id)
+            self.gen += 1
+
+    def invalidate(self):
+        with self.lock:
+            self.ready = False
+            self.gen += 1
+
+    def stale(self):
+        if not self.ready:
+            return True
+        age = time.monotonic() - self.loaded_at
+        if age > TYPEAHEAD_MAX_AGE:
+            return True
+        return not listener_connected() and age > TYPEAHEAD_FALLBACK_AGE
+
+    def search(self, q, limit):
+        terms = text_tokens(q)
+        if not terms:
+            return []
+        with self.lock:
+            postings = []
+            for t in terms:
+                for gram in token_grams(t):
+                    posting = self.grams.get(gram)
+                    if not posting:
+                        return []
+                    postings.append(posting)
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates &= posting
+                if not candidates:
+                    return []
+
+            hits = []
+            for aluno_id in candidates:
+                doc, nome_tokens, tokens, nome_norm = self.docs[aluno_id]
+                score = 0
+                for t in terms:
+                    if t in nome_tokens:
+                        score += 3
+                    elif any(n.startswith(t) for n in nome_tokens):
+                        score += 2
+                    elif any(n.startswith(t) for n in tokens):
+                        score += 1
+                    else:
+                        score = None
+                        break
+                if score is not None:
+                    hits.append((-score, nome_norm, aluno_id, doc))
+        hits.sort(key=lambda h: h[:3])
+        return [dict(h[3]) for h in hits[:limit]]
+
+
+typeahead = TypeaheadIndex()
+
+
+TYPEAHEAD_LOAD_ATTEMPTS = 3
+
+
+def ensure_typeahead():
+    if not typeahead.stale():
+        return
+    with typeahead.load_lock:
+        for _ in range(TYPEAHEAD_LOAD_ATTEMPTS):
+            if not typeahead.stale():
+                return
+            gen = typeahead.generation()
+            with db() as conn, conn.cursor() as cur:
+                cur.execute(f"SELECT id, {', '.join(TYPEAHEAD_FIELDS)} FROM alunos")
+                rows = cur.fetchall()
+            if typeahead.load(rows, gen):
+                return
+        # escritas seguidas: fica o índice atual (com as escritas), ainda velho, e a
+        # próxima chamada tenta de novo
+
+
+@on_signal("aluno")
+def _typeahead_on_aluno(data):
+    # o próprio worker já aplicou a mudança no request
+    if signal_from_self(data):
+        return
+    if not typeahead.ready:
+        # pode haver recarga em andamento com leitura de antes deste commit
+        typeahead.invalidate()
+        return
+    aluno_id = data.get("id")
+    if data.get("removido"):
+        typeahead.remove(aluno_id)
+        return
+    with db() as conn, conn.cursor() as cur:
+        cur.execute(f"SELECT id, {', '.join(TYPEAHEAD_FIELDS)} FROM alunos WHERE id=%s", (aluno_id,))
+        row = cur.fetchone()
+    if row:
+        typeahead.upsert(row)
+    else:
+        typeahead.remove(aluno_id)
+
+
+@on_signal("alunos_recarregar")
+@on_signal("reset")
+def _typeahead_on_reset(data):
+    typeahead.invalidate()
+
+
+# ---------------- CLI ----------------
+CLI_COMMANDS = {}
+
+
+def cli_command(name):
+    """Registra um comando de manutenção: `python server.py <nome> [args...]`."""
+    def deco(fn):
+        CLI_COMMANDS[name] = fn
+        return fn
+    return deco
+
+
+# ---------------- Migrações ----------------
+# Cada passo roda uma vez, em ordem, registrado em schema_version. Rode com
+# `python server.py migrar-banco` (release do Procfile); os workers só conferem a versão.
+# Os passos usam IF NOT EXISTS porque bancos antigos já têm parte do schema.
+MIGRATIONS = []
+MIGRATION_LOCK_ID = 72_105_113  # chave do pg_advisory_lock das migrações
+MIGRATE_ON_START = os.getenv("MIGRATE_ON_START", "0") == "1"
+
+# contagens de uma aula a partir de frequencia (backfill e encerramento)
+AULA_CONTAGEM_SET = """
+    total_criancas = (SELECT COUNT(*) FROM frequencia f WHERE f.id_aula = a.id),
+    total_saidas = (SELECT COUNT(*) FROM frequencia f WHERE f.id_aula = a.id AND f.horario_saida IS NOT NULL)
+"""
+
+
+def migration(versao, nome):
+    """Registra um passo de migração; as versões precisam ser crescentes."""
+    def deco(fn):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] < versao, "versões de migração fora de ordem"
+        MIGRATIONS.append((versao, nome, fn))
+        return fn
+    return deco
+
+
+@migration(1, "tabelas base")
+def _m001_tabelas_base(cur):
     cur.execute("""
     CREATE TABLE IF NOT EXISTS usuarios (
         id SERIAL PRIMARY KEY,
@@ -201,18 +1690,301 @@ def ensure_tables():
             ("Administrador", "admin", "1234", "admin")
         )
 
-    conn.commit()
-    cur.close()
-    conn.close()
 
+@migration(2, "contadores do mural")
+def _m002_contadores_mural(cur):
+    # NULL = coluna recém-criada, ainda sem backfill
+    cur.execute("ALTER TABLE avisos ADD COLUMN IF NOT EXISTS like_count INTEGER")
+    cur.execute("ALTER TABLE avisos ADD COLUMN IF NOT EXISTS comment_count INTEGER")
+    cur.execute("""
+        UPDATE avisos a
+        SET like_count = (SELECT COUNT(*) FROM avisos_likes l WHERE l.aviso_id = a.id)
+        WHERE a.like_count IS NULL
+    """)
+    cur.execute("""
+        UPDATE avisos a
+        SET comment_count = (SELECT COUNT(*) FROM avisos_comentarios c WHERE c.aviso_id = a.id)
+        WHERE a.comment_count IS NULL
+    """)
+    cur.execute("ALTER TABLE avisos ALTER COLUMN like_count SET DEFAULT 0")
+    cur.execute("ALTER TABLE avisos ALTER COLUMN like_count SET NOT NULL")
+    cur.execute("ALTER TABLE avisos ALTER COLUMN comment_count SET DEFAULT 0")
+    cur.execute("ALTER TABLE avisos ALTER COLUMN comment_count SET NOT NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS avisos_likes_user_idx ON avisos_likes (user_id, aviso_id)")
+
+
+@migration(3, "busca sem acento por trigramas")
+def _m003_busca(cur):
+    cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    cur.execute("CREATE EXTENSION IF NOT EXISTS unaccent")
+    cur.execute("SELECT extnamespace::regnamespace::text AS schema FROM pg_extension WHERE extname='unaccent'")
+    unaccent_schema = cur.fetchone()["schema"]
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION busca_normalizada(TEXT) RETURNS TEXT
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+        AS $$ SELECT lower({unaccent_schema}.unaccent('{unaccent_schema}.unaccent'::regdictionary, $1)) $$
+    """)
+    cur.execute("""
+        ALTER TABLE alunos ADD COLUMN IF NOT EXISTS busca TEXT
+        GENERATED ALWAYS AS (busca_normalizada(COALESCE(nome, '') || ' ' || COALESCE(responsavel, ''))) STORED
+    """)
+    cur.execute("""
+        ALTER TABLE usuarios ADD COLUMN IF NOT EXISTS busca TEXT
+        GENERATED ALWAYS AS (busca_normalizada(COALESCE(nome, '') || ' ' || COALESCE(usuario, ''))) STORED
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS alunos_busca_trgm_idx ON alunos USING gin (busca gin_trgm_ops)")
+    cur.execute("CREATE INDEX IF NOT EXISTS usuarios_busca_trgm_idx ON usuarios USING gin (busca gin_trgm_ops)")
 
-try:
-    ensure_tables()
-except Exception as e:
-    print("⚠️ Falha ao preparar/migrar tabelas:", e)
+
+@migration(4, "índices da paginação")
+def _m004_paginacao(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS alunos_nome_id_idx ON alunos ((COALESCE(nome, '')), id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS usuarios_nome_id_idx ON usuarios ((COALESCE(nome, '')), id)")
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS avisos_feed_idx
+        ON avisos (fixado DESC, (COALESCE(data_criacao, {EPOCH})) DESC, id DESC)
+    """)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS aulas_historico_idx
+        ON aulas ((COALESCE(data_aula, {EPOCH})) DESC, id DESC)
+        WHERE encerrada_em IS NOT NULL
+    """)
+    cur.execute(f"""
+        CREATE INDEX IF NOT EXISTS avisos_comentarios_aviso_idx
+        ON avisos_comentarios (aviso_id, (COALESCE(created_at, {EPOCH})), id)
+    """)
+
+
+@migration(5, "índice da aula ativa")
+def _m005_aula_ativa(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS aulas_ativa_idx ON aulas (data_aula DESC) WHERE encerrada_em IS NULL")
+
+
+@migration(6, "chave natural da importação de alunos")
+def _m006_chave_natural(cur):
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS alunos_chave_natural_idx
+        ON alunos (busca_normalizada(nome), COALESCE(data_nascimento, ''), COALESCE(busca_normalizada(responsavel), ''))
+    """)
+
+
+@migration(7, "agregados de analytics")
+def _m007_analytics(cur):
+    # atualizados a cada aula encerrada (ver analytics_processar_aula)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS analytics_aulas_processadas (
+        aula_id INTEGER PRIMARY KEY REFERENCES aulas(id) ON DELETE CASCADE,
+        processada_em TIMESTAMP DEFAULT NOW()
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS analytics_alunos (
+        aluno_id INTEGER PRIMARY KEY REFERENCES alunos(id) ON DELETE CASCADE,
+        presencas INTEGER NOT NULL DEFAULT 0,
+        aulas INTEGER NOT NULL DEFAULT 0,
+        faltas_seguidas INTEGER NOT NULL DEFAULT 0,
+        maior_sequencia_faltas INTEGER NOT NULL DEFAULT 0,
+        ultima_presenca TIMESTAMP
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS analytics_alunos_faltas_idx ON analytics_alunos (faltas_seguidas DESC, aluno_id)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS analytics_mensal (
+        mes DATE PRIMARY KEY,
+        aulas INTEGER NOT NULL DEFAULT 0,
+        presencas INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS analytics_professores (
+        professor TEXT NOT NULL,
+        papel TEXT NOT NULL,
+        aulas INTEGER NOT NULL DEFAULT 0,
+        presencas INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (professor, papel)
+    )
+    """)
+
+
+@migration(8, "contagens por aula")
+def _m008_contagens_aula(cur):
+    # mantidas pelos check-ins/saídas e fechadas no encerramento
+    for coluna in ("total_criancas", "total_saidas"):
+        cur.execute(f"ALTER TABLE aulas ADD COLUMN IF NOT EXISTS {coluna} INTEGER")
+    cur.execute(f"UPDATE aulas a SET {AULA_CONTAGEM_SET} WHERE a.total_criancas IS NULL OR a.total_saidas IS NULL")
+    for coluna in ("total_criancas", "total_saidas"):
+        cur.execute(f"ALTER TABLE aulas ALTER COLUMN {coluna} SET DEFAULT 0")
+        cur.execute(f"ALTER TABLE aulas ALTER COLUMN {coluna} SET NOT NULL")
+
+
+@migration(9, "versões por tabela (ETag)")
+def _m009_versoes(cur):
+    # qualquer escrita (rotas, importação, CLI) incrementa a versão da tabela
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS versoes (
+        tabela TEXT PRIMARY KEY,
+        versao BIGINT NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION versoes_bump() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO versoes (tabela, versao) VALUES (TG_TABLE_NAME, 1)
+            ON CONFLICT (tabela) DO UPDATE SET versao = versoes.versao + 1;
+            RETURN NULL;
+        END
+        $$
+    """)
+    for tabela in ("alunos", "usuarios", "avisos", "avisos_likes", "avisos_comentarios", "aulas",
+                   "frequencia", "analytics_alunos", "analytics_mensal", "analytics_professores"):
+        cur.execute(f"DROP TRIGGER IF EXISTS {tabela}_versao ON {tabela}")
+        cur.execute(f"""
+            CREATE TRIGGER {tabela}_versao
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {tabela}
+            FOR EACH STATEMENT EXECUTE PROCEDURE versoes_bump()
+        """)
+
+
+@migration(10, "contadores do painel")
+def _m010_contadores(cur):
+    # mantidos por triggers de statement com tabelas de transição: um UPDATE por comando, não por linha
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS contadores (
+        nome TEXT PRIMARY KEY,
+        valor BIGINT NOT NULL DEFAULT 0
+    )
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION contadores_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE contadores SET valor = valor + (SELECT COUNT(*) FROM novas) WHERE nome = TG_TABLE_NAME;
+            RETURN NULL;
+        END
+        $$
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION contadores_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE contadores SET valor = valor - (SELECT COUNT(*) FROM antigas) WHERE nome = TG_TABLE_NAME;
+            RETURN NULL;
+        END
+        $$
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION contadores_truncate() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE contadores SET valor = 0 WHERE nome = TG_TABLE_NAME;
+            RETURN NULL;
+        END
+        $$
+    """)
+    for tabela in ("alunos", "usuarios", "avisos"):
+        cur.execute(f"DROP TRIGGER IF EXISTS {tabela}_contador_ins ON {tabela}")
+        cur.execute(f"DROP TRIGGER IF EXISTS {tabela}_contador_del ON {tabela}")
+        cur.execute(f"DROP TRIGGER IF EXISTS {tabela}_contador_trunc ON {tabela}")
+        cur.execute(f"""
+            CREATE TRIGGER {tabela}_contador_ins AFTER INSERT ON {tabela}
+            REFERENCING NEW TABLE AS novas FOR EACH STATEMENT EXECUTE PROCEDURE contadores_insert()
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER {tabela}_contador_del AFTER DELETE ON {tabela}
+            REFERENCING OLD TABLE AS antigas FOR EACH STATEMENT EXECUTE PROCEDURE contadores_delete()
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER {tabela}_contador_trunc AFTER TRUNCATE ON {tabela}
+            FOR EACH STATEMENT EXECUTE PROCEDURE contadores_truncate()
+        """)
+        # contagem inicial depois dos triggers: o CREATE TRIGGER já bloqueia escritas até o commit
+        cur.execute(f"""
+            INSERT INTO contadores (nome, valor) SELECT %s, COUNT(*) FROM {tabela}
+            ON CONFLICT (nome) DO UPDATE SET valor = EXCLUDED.valor
+        """, (tabela,))
+
+
+@migration(11, "índice do check-in por responsável")
+def _m011_responsavel(cur):
+    # check-in em lote de todos os filhos: WHERE busca_normalizada(responsavel) = busca_normalizada(%s)
+    cur.execute("CREATE INDEX IF NOT EXISTS alunos_responsavel_idx ON alunos (busca_normalizada(responsavel))")
+
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_schema_version(cur):
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL AS existe")
+    if not cur.fetchone()["existe"]:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(versao), 0) AS versao FROM schema_version")
+    return cur.fetchone()["versao"]
+
+
+def migrate():
+    """Aplica as migrações pendentes; o advisory lock garante um processo por vez."""
+    aplicadas = []
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                versao INTEGER PRIMARY KEY,
+                nome TEXT NOT NULL,
+                aplicada_em TIMESTAMP DEFAULT NOW()
+            )
+            """)
+            conn.commit()
+            # relê depois do lock: outro processo pode ter acabado de migrar
+            atual = current_schema_version(cur)
+            for versao, nome, fn in MIGRATIONS:
+                if versao <= atual:
+                    continue
+                # cada passo na sua transação, junto com o registro em schema_version
+                fn(cur)
+                cur.execute("INSERT INTO schema_version (versao, nome) VALUES (%s, %s)", (versao, nome))
+                conn.commit()
+                aplicadas.append((versao, nome))
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+            conn.commit()
+    return aplicadas
+
+
+def check_schema():
+    """Na subida só confere a versão do banco (uma consulta, sem DDL)."""
+    if MIGRATE_ON_START:
+        migrate()
+    with db() as conn, conn.cursor() as cur:
+        atual = current_schema_version(cur)
+    if atual < SCHEMA_VERSION:
+        print(f"⚠️ Banco na versão {atual}, o código espera {SCHEMA_VERSION}: rode `python server.py migrar-banco`")
+    elif atual > SCHEMA_VERSION:
+        print(f"⚠️ Banco na versão {atual}, mais nova que a do código ({SCHEMA_VERSION})")
+    return atual
+
+
+@cli_command("migrar-banco")
+def migrar_banco(args):
+    """Aplica as migrações pendentes do schema"""
+    for versao, nome in migrate():
+        print(f"migração {versao:03d} aplicada: {nome}")
+    print(f"schema na versão {SCHEMA_VERSION}")
+
+
+if not (__name__ == "__main__" and sys.argv[1:2] == ["migrar-banco"]):
+    try:
+        check_schema()
+    except Exception as e:
+        print("⚠️ Falha ao verificar o schema:", e)
 
 
 # ---------------- Routes ----------------
+@app.before_request
+def _start_listener():
+    ensure_listener()
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -223,11 +1995,150 @@ def sw_root():
     return send_from_directory(app.static_folder, "sw.js")
 
 
+def send_blob(key):
+    f = blobs.open(key)
+    mimetype = sniff_mimetype(f.read(12))
+    f.seek(0)
+    resp = send_file(f, mimetype=mimetype, etag=key, conditional=True, max_age=MEDIA_CACHE_SECONDS)
+    resp.headers["Cache-Control"] = f"public, max-age={MEDIA_CACHE_SECONDS}, immutable"
+    return resp
+
+
+@app.route("/media/<key>")
+def media(key):
+    """Serve um blob pelo hash; o conteúdo nunca muda, então o cache é imutável"""
+    if not MEDIA_KEY_RE.match(key) or not blobs.exists(key):
+        abort(404)
+    return send_blob(key)
+
+
+@app.route("/media/<key>/<variant>")
+def media_variant(key, variant):
+    """Serve uma variante redimensionada; enquanto não existe, redireciona para o original"""
+    if not MEDIA_KEY_RE.match(key) or variant not in IMAGE_VARIANTS:
+        abort(404)
+    vkey = variant_key(key, variant)
+    if blobs.exists(vkey):
+        return send_blob(vkey)
+    if not blobs.exists(key):
+        abort(404)
+    enqueue_variants(key)
+    # redirect sem cache: nenhum cache (nem o do service worker) guarda o original
+    # no lugar da miniatura, e o próximo acesso já pega a variante pronta
+    resp = redirect(media_url(key), 302)
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+
+@app.post("/api/eventos/token")
+@require_auth
+def eventos_token():
+    """Token curto para abrir o /api/eventos sem pôr o token da sessão na URL"""
+    token = stream_serializer.dumps({"id": request.user.get("id")})
+    return jsonify({"ok": True, "token": token, "expira_em": STREAM_TOKEN_MAX_AGE_SECONDS})
+
+
+@app.route("/api/eventos")
+def eventos():
+    """Stream SSE de check-ins, saídas e atividade do mural"""
+    # EventSource não envia cabeçalhos: aceita só o token de stream na query, nunca o da sessão
+    token = (request.args.get("token") or "").strip()
+    if not token:
+        return api_error("Não autenticado", 401)
+    try:
+        stream_serializer.loads(token, max_age=STREAM_TOKEN_MAX_AGE_SECONDS)
+    except SignatureExpired:
+        return api_error("Token de eventos expirado", 401)
+    except BadSignature:
+        return api_error("Token inválido", 401)
+
+    q = sse_subscribe()
+    if q is None:
+        # 503 faria o EventSource desistir de vez; com 200 + retry ele volta mais tarde.
+        # O id faz a reconexão chegar com Last-Event-ID e receber um resync.
+        retry = int(SSE_BUSY_RETRY_MS * random.uniform(0.5, 1.5))
+        return Response(f"retry: {retry}\nid: 0\n: ocupado\n\n", mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-store"})
+    # reconexão: eventos podem ter se perdido enquanto o cliente estava fora (o app
+    # marca com ?reconexao=1 quando precisa abrir um EventSource novo com outro token)
+    reconectou = request.headers.get("Last-Event-ID") is not None or request.args.get("reconexao") == "1"
+
+    def stream():
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        try:
+            yield "retry: 3000\n: conectado\n\n"
+            if reconectou:
+                yield "event: resync\ndata: {}\n\n"
+            while time.monotonic() < deadline:
+                try:
+                    event = q.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    break
+                data = app.json.dumps(event["dados"])
+                yield f"id: {event['id']}\nevent: {event['tipo']}\ndata: {data}\n\n"
+        finally:
+            sse_unsubscribe(q)
+
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
 @app.route("/api/health")
 def health():
     return jsonify({"ok": True, "time": datetime.utcnow().isoformat()})
 
 
+@app.route("/api/db/pool")
+@require_auth
+def db_pool_stats():
+    """Estatísticas do pool deste worker (tamanho, ocupação e tempo de espera)"""
+    if not is_admin():
+        return api_error("Apenas admin", 403)
+    return jsonify({"ok": True, "pool": get_pool().snapshot()})
+
+
+@app.route("/api/db/lentas")
+@require_auth
+def db_consultas_lentas():
+    """Consultas lentas recentes de todos os workers (?min_ms=N), da mais nova para a mais antiga"""
+    if not is_admin():
+        return api_error("Apenas admin", 403)
+    try:
+        min_ms = float(request.args.get("min_ms") or 0)
+    except ValueError:
+        return api_error("min_ms inválido", 400)
+    entries = sorted((e for e in load_slow_queries() if e["ms"] >= min_ms), key=lambda e: e["em"], reverse=True)
+    return jsonify({
+        "ok": True,
+        "pid": os.getpid(),
+        "workers": sorted({e["pid"] for e in entries}),
+        "limite_ms": SLOW_QUERY_MS,
+        "amostra_explain": SLOW_QUERY_EXPLAIN_RATE,
+        "consultas": entries,
+    })
+
+
+@app.route("/api/metrics")
+def metrics():
+    """Métricas em formato Prometheus, somadas entre os workers do gunicorn"""
+    if METRICS_TOKEN and get_bearer_token() != METRICS_TOKEN:
+        return api_error("Não autorizado", 401)
+    if prometheus_client is None:
+        return api_error("prometheus_client não está instalado", 503)
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry),
+                    headers={"Content-Type": prometheus_client.CONTENT_TYPE_LATEST})
+
+
 # ---------------- Auth API ----------------
 @app.route("/api/login", methods=["POST"])
 def login():
@@ -239,15 +2150,12 @@ def login():
         return api_error("Informe usuário e senha", 400)
 
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, nome, usuario, role, telefone, email, foto, senha FROM usuarios WHERE usuario=%s",
-            (usuario,)
-        )
-        u = cur.fetchone()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            cur.execute(
+                "SELECT id, nome, usuario, role, telefone, email, foto, senha FROM usuarios WHERE usuario=%s",
+                (usuario,)
+            )
+            u = cur.fetchone()
     except Exception as e:
         return api_error("Erro ao consultar usuário", 500, e)
 
@@ -265,7 +2173,7 @@ def login():
             "role": u.get("role") or "membro",
             "telefone": u.get("telefone"),
             "email": u.get("email"),
-            "foto": u.get("foto"),
+            "foto": variant_url(u.get("foto"), "avatar"),
         }
     })
 
@@ -275,44 +2183,63 @@ def login():
 def me():
     uid = request.user["id"]
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("SELECT id, nome, usuario, role, telefone, email, foto FROM usuarios WHERE id=%s", (uid,))
-        u = cur.fetchone()
-        cur.close()
-        conn.close()
+        u = user_directory.get(uid)
     except Exception as e:
         return api_error("Erro ao buscar usuário", 500, e)
 
     if not u:
         return api_error("Usuário não encontrado", 404)
 
+    u["foto"] = variant_url(u.get("foto"), "avatar")
     return jsonify({"ok": True, "usuario": u})
 
 
 # ---------------- Stats ----------------
+# contadores mantidos por trigger (migração 10) + contagens da aula aberta, cacheados por worker
+ESTATISTICAS_TTL = float(os.getenv("ESTATISTICAS_TTL", "10"))
+_estatisticas = {"data": None, "loaded_at": 0.0}
+_estatisticas_lock = threading.Lock()
+
+
+def load_estatisticas():
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT
+                (SELECT valor FROM contadores WHERE nome = 'alunos') AS total_alunos,
+                (SELECT valor FROM contadores WHERE nome = 'usuarios') AS total_equipe,
+                (SELECT valor FROM contadores WHERE nome = 'avisos') AS total_avisos,
+                au.id AS aula_id, au.total_criancas, au.total_saidas
+            FROM (SELECT 1) AS um
+            LEFT JOIN LATERAL (
+                SELECT id, total_criancas, total_saidas FROM aulas
+                WHERE encerrada_em IS NULL ORDER BY data_aula DESC LIMIT 1
+            ) au ON TRUE
+        """)
+        r = cur.fetchone()
+    return {
+        "total_alunos": r["total_alunos"] or 0,
+        "total_equipe": r["total_equipe"] or 0,
+        "total_avisos": r["total_avisos"] or 0,
+        "aula_ativa": {
+            "id": r["aula_id"],
+            "total_criancas": r["total_criancas"],
+            "presentes": r["total_criancas"] - r["total_saidas"],
+        } if r["aula_id"] else None,
+    }
+
+
 @app.route("/api/estatisticas")
 @require_auth
 def estatisticas():
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*)::int AS total FROM alunos")
-        total_alunos = cur.fetchone()["total"]
-
-        cur.execute("SELECT COUNT(*)::int AS total FROM usuarios")
-        total_equipe = cur.fetchone()["total"]
-
-        cur.execute("SELECT COUNT(*)::int AS total FROM avisos")
-        total_avisos = cur.fetchone()["total"]
-
-        cur.close()
-        conn.close()
-        return jsonify({
-            "total_alunos": total_alunos, 
-            "total_equipe": total_equipe,
-            "total_avisos": total_avisos
-        })
+        with _estatisticas_lock:
+            fresh = _estatisticas["data"] and time.monotonic() - _estatisticas["loaded_at"] < ESTATISTICAS_TTL
+            data = _estatisticas["data"]
+        if not fresh:
+            data = load_estatisticas()
+            with _estatisticas_lock:
+                _estatisticas.update(data=data, loaded_at=time.monotonic())
+        return jsonify(data)
     except Exception as e:
         return api_error("Erro ao carregar estatísticas", 500, e)
 
@@ -322,56 +2249,80 @@ def estatisticas():
 # ==========================================================
 @app.route("/api/alunos", methods=["GET"])
 @require_auth
+@conditional("alunos")
 def alunos_list():
     q = (request.args.get("q") or "").strip()
     try:
-        conn = db()
-        cur = conn.cursor()
-        if q:
-            cur.execute("""
-                SELECT id, nome, data_nascimento, responsavel, telefone, observacoes,
-                       autorizado_retirar, autorizado_2, autorizado_3, foto
-                FROM alunos
-                WHERE nome ILIKE %s OR responsavel ILIKE %s
-                ORDER BY nome ASC
-                LIMIT 500
-            """, (f"%{q}%", f"%{q}%"))
-        else:
-            cur.execute("""
-                SELECT id, nome, data_nascimento, responsavel, telefone, observacoes,
-                       autorizado_retirar, autorizado_2, autorizado_3, foto
-                FROM alunos
-                ORDER BY nome ASC
-                LIMIT 500
-            """)
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return jsonify(rows)
+        page = read_page("alunos", ALUNOS_KEYS, 500)
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    try:
+        with db() as conn, conn.cursor() as cur:
+            if q:
+                # busca devolve uma página única, ordenada pela semelhança
+                cond, rank, params = search_sql(q)
+                cur.execute(f"""
+                    SELECT id, nome, data_nascimento, responsavel, telefone, observacoes,
+                           autorizado_retirar, autorizado_2, autorizado_3, foto
+                    FROM alunos
+                    WHERE {cond}
+                    ORDER BY {rank} DESC, COALESCE(nome, ''), id
+                    LIMIT %s
+                """, (*params, page.limit))
+                rows, next_cursor = cur.fetchall(), None
+            else:
+                keys, after, params, order = page_sql(page)
+                cur.execute(f"""
+                    SELECT id, nome, data_nascimento, responsavel, telefone, observacoes,
+                           autorizado_retirar, autorizado_2, autorizado_3, foto, {keys}
+                    FROM alunos
+                    WHERE {after}
+                    ORDER BY {order}
+                    LIMIT %s
+                """, (*params, page.limit + 1))
+                rows, next_cursor = finish_page(page, cur.fetchall())
+        return page_response(page, with_variant(rows, "foto", "avatar"), next_cursor)
     except Exception as e:
         return api_error("Erro ao listar alunos", 500, e)
 
 
+@app.route("/api/alunos/sugestoes", methods=["GET"])
+@require_auth
+def alunos_sugestoes():
+    """Sugestões para o check-in, respondidas pelo índice em memória do worker"""
+    q = (request.args.get("q") or "").strip()
+    try:
+        limit = max(1, min(int(request.args.get("limit") or 10), 50))
+    except ValueError:
+        return api_error("limit inválido", 400)
+
+    try:
+        ensure_typeahead()
+    except Exception as e:
+        return api_error("Erro ao carregar sugestões", 500, e)
+    return jsonify({"ok": True, "sugestoes": typeahead.search(q, limit)})
+
+
 @app.route("/api/alunos/<int:aluno_id>", methods=["GET"])
 @require_auth
+@conditional("alunos")
 def alunos_get(aluno_id):
     """Busca um aluno específico por ID"""
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT id, nome, data_nascimento, responsavel, telefone, observacoes,
-                   autorizado_retirar, autorizado_2, autorizado_3, foto
-            FROM alunos
-            WHERE id = %s
-        """, (aluno_id,))
-        aluno = cur.fetchone()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT id, nome, data_nascimento, responsavel, telefone, observacoes,
+                       autorizado_retirar, autorizado_2, autorizado_3, foto
+                FROM alunos
+                WHERE id = %s
+            """, (aluno_id,))
+            aluno = cur.fetchone()
         
         if not aluno:
             return api_error("Aluno não encontrado", 404)
-            
+
+        aluno["foto"] = variant_url(aluno.get("foto"), "full")
         return jsonify(aluno)
     except Exception as e:
         print("Erro em /api/alunos/<int:aluno_id>:", str(e))
@@ -386,6 +2337,11 @@ def alunos_create():
     if not nome:
         return api_error("Nome do aluno é obrigatório", 400)
 
+    try:
+        foto = store_image(data.get("foto"))
+    except ValueError as e:
+        return api_error(str(e), 400)
+
     payload = (
         nome,
         (data.get("data_nascimento") or "").strip(),
@@ -395,23 +2351,23 @@ def alunos_create():
         (data.get("autorizado_retirar") or "").strip(),
         (data.get("autorizado_2") or "").strip(),
         (data.get("autorizado_3") or "").strip(),
-        (data.get("foto") or "").strip() or None,
+        foto,
     )
 
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO alunos
-            (nome, data_nascimento, responsavel, telefone, observacoes,
-             autorizado_retirar, autorizado_2, autorizado_3, foto)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
-            RETURNING id
-        """, payload)
-        new_id = cur.fetchone()["id"]
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                INSERT INTO alunos
+                (nome, data_nascimento, responsavel, telefone, observacoes,
+                 autorizado_retirar, autorizado_2, autorizado_3, foto)
+                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                RETURNING id, {', '.join(TYPEAHEAD_FIELDS)}
+            """, payload)
+            row = cur.fetchone()
+            new_id = row["id"]
+            notify(cur, "aluno", id=new_id)
+            conn.commit()
+        typeahead.upsert(row)
         return jsonify({"ok": True, "id": new_id})
     except Exception as e:
         return api_error("Erro ao cadastrar aluno", 500, e)
@@ -425,6 +2381,11 @@ def alunos_update(aluno_id):
     if not nome:
         return api_error("Nome do aluno é obrigatório", 400)
 
+    try:
+        foto = store_image(data.get("foto"))
+    except ValueError as e:
+        return api_error(str(e), 400)
+
     payload = (
         nome,
         (data.get("data_nascimento") or "").strip(),
@@ -434,22 +2395,25 @@ def alunos_update(aluno_id):
         (data.get("autorizado_retirar") or "").strip(),
         (data.get("autorizado_2") or "").strip(),
         (data.get("autorizado_3") or "").strip(),
-        (data.get("foto") or "").strip() or None,
+        foto,
         aluno_id
     )
 
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE alunos
-            SET nome=%s, data_nascimento=%s, responsavel=%s, telefone=%s, observacoes=%s,
-                autorizado_retirar=%s, autorizado_2=%s, autorizado_3=%s, foto=%s
-            WHERE id=%s
-        """, payload)
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                UPDATE alunos
+                SET nome=%s, data_nascimento=%s, responsavel=%s, telefone=%s, observacoes=%s,
+                    autorizado_retirar=%s, autorizado_2=%s, autorizado_3=%s, foto=%s
+                WHERE id=%s
+                RETURNING id, {', '.join(TYPEAHEAD_FIELDS)}
+            """, payload)
+            row = cur.fetchone()
+            if row:
+                notify(cur, "aluno", id=aluno_id)
+            conn.commit()
+        if row:
+            typeahead.upsert(row)
         return jsonify({"ok": True})
     except Exception as e:
         return api_error("Erro ao atualizar aluno", 500, e)
@@ -459,46 +2423,239 @@ def alunos_update(aluno_id):
 @require_auth
 def alunos_delete(aluno_id):
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM alunos WHERE id=%s", (aluno_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            # o CASCADE levaria as presenças sem mexer nas contagens das aulas: remove antes e desconta
+            cur.execute("""
+                WITH removidas AS (
+                    DELETE FROM frequencia WHERE id_aluno = %s RETURNING id_aula, horario_saida
+                )
+                SELECT id_aula, COUNT(*) AS entradas, COUNT(horario_saida) AS saidas
+                FROM removidas GROUP BY id_aula ORDER BY id_aula
+            """, (aluno_id,))
+            for r in cur.fetchall():
+                contar_presencas(cur, r["id_aula"], entradas=-r["entradas"], saidas=-r["saidas"])
+            cur.execute("DELETE FROM alunos WHERE id=%s", (aluno_id,))
+            notify(cur, "aluno", id=aluno_id, removido=True)
+            conn.commit()
+        typeahead.remove(aluno_id)
         return jsonify({"ok": True})
     except Exception as e:
         return api_error("Erro ao excluir aluno", 500, e)
 
 
+# ==========================================================
+# IMPORTAÇÃO DE ALUNOS (CSV via COPY)
+# ==========================================================
+IMPORT_COLUMNS = ("nome", "data_nascimento", "responsavel", "telefone", "observacoes",
+                  "autorizado_retirar", "autorizado_2", "autorizado_3")
+# cabeçalhos aceitos (já normalizados: sem acento, minúsculos, espaços -> _)
+IMPORT_ALIASES = {
+    "aluno": "nome", "nome_do_aluno": "nome", "crianca": "nome", "nome_da_crianca": "nome",
+    "nascimento": "data_nascimento", "data_de_nascimento": "data_nascimento", "dt_nascimento": "data_nascimento",
+    "responsaveis": "responsavel", "pai_mae": "responsavel", "nome_do_responsavel": "responsavel",
+    "fone": "telefone", "celular": "telefone", "whatsapp": "telefone",
+    "obs": "observacoes", "observacao": "observacoes",
+    "autorizado": "autorizado_retirar", "autorizado_1": "autorizado_retirar",
+}
+IMPORT_ENCODINGS = {"utf8": "UTF8", "utf-8": "UTF8", "latin1": "LATIN1", "latin-1": "LATIN1",
+                    "iso-8859-1": "LATIN1", "cp1252": "WIN1252", "win1252": "WIN1252"}
+IMPORT_MAX_ERROS = 50
+# chave natural usada para decidir entre atualizar e inserir
+IMPORT_KEY = "busca_normalizada({t}.nome), COALESCE({t}.data_nascimento, ''), COALESCE(busca_normalizada({t}.responsavel), '')"
+
+
+def import_header(line, encoding):
+    """Decodifica a linha de cabeçalho e devolve (delimitador, colunas da tabela de staging)."""
+    text = line.decode("utf-8-sig" if encoding == "UTF8" else "cp1252").strip("\r\n")
+    delimiter = max((";", ",", "\t"), key=text.count)
+    names = next(csv.reader([text], delimiter=delimiter))
+    columns, vistos = [], set()
+    for i, name in enumerate(names):
+        key = re.sub(r"\W+", "_", normalize_text(name).strip()).strip("_")
+        key = IMPORT_ALIASES.get(key, key)
+        if key in IMPORT_COLUMNS and key not in vistos:
+            vistos.add(key)
+            columns.append(key)
+        else:
+            columns.append(f"_ignorar_{i}")
+    if "nome" not in vistos:
+        raise ValueError("O arquivo precisa de uma coluna 'nome'")
+    return delimiter, columns
+
+
+def importar_alunos(stream, encoding="UTF8"):
+    """Importa alunos de um CSV sem carregar o arquivo na memória.
+
+    O arquivo vai direto do stream para uma tabela temporária via COPY; a validação e o
+    merge (UPDATE dos existentes pela chave natural, INSERT dos novos) rodam no banco,
+    tudo numa transação só. Levanta ValueError para arquivos que não dá para importar.
+    Não funciona com o psycopg2 em modo cooperativo (psycogreen): COPY não aceita wait callback.
+    """
+    header = stream.readline()
+    if not header:
+        raise ValueError("Arquivo vazio")
+    delimiter, columns = import_header(header, encoding)
+    present = [c for c in IMPORT_COLUMNS if c in columns]
+    # a staging tem todas as colunas (IMPORT_KEY usa as da chave mesmo fora do arquivo);
+    # o COPY preenche só as do cabeçalho e o resto fica NULL
+    staging = list(IMPORT_COLUMNS) + [c for c in columns if c not in IMPORT_COLUMNS]
+
+    with db() as conn, conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TEMP TABLE importacao_alunos (
+                linha BIGSERIAL,
+                {", ".join(f"{c} TEXT" for c in staging)},
+                motivo TEXT
+            ) ON COMMIT DROP
+        """)
+        try:
+            cur.copy_expert(
+                f"COPY importacao_alunos ({', '.join(columns)}) FROM STDIN "
+                f"WITH (FORMAT csv, DELIMITER '{delimiter}', ENCODING '{encoding}')",
+                stream,
+            )
+        except (psycopg2.DataError, psycopg2.errors.BadCopyFileFormat) as e:
+            raise ValueError(f"CSV inválido: {e.pgerror or e}")
+        lidas = cur.rowcount
+
+        cur.execute(f"""
+            UPDATE importacao_alunos
+            SET {", ".join(f"{c} = NULLIF(btrim({c}), '')" for c in present)}
+        """)
+        cur.execute("UPDATE importacao_alunos SET motivo = 'nome vazio' WHERE nome IS NULL")
+        # a mesma criança repetida no arquivo: vale a última linha
+        cur.execute(f"""
+            UPDATE importacao_alunos s SET motivo = 'linha repetida no arquivo'
+            FROM (
+                SELECT linha, row_number() OVER (
+                    PARTITION BY {IMPORT_KEY.format(t="o")} ORDER BY linha DESC
+                ) AS ordem
+                FROM importacao_alunos o WHERE o.motivo IS NULL
+            ) r
+            WHERE r.linha = s.linha AND r.ordem > 1
+        """)
+        cur.execute("ANALYZE importacao_alunos")
+
+        mutaveis = [c for c in present if c != "nome"]
+        atualizados = 0
+        if mutaveis:
+            cur.execute(f"""
+                UPDATE alunos a
+                SET {", ".join(f"{c} = COALESCE(s.{c}, a.{c})" for c in mutaveis)}
+                FROM importacao_alunos s
+                WHERE s.motivo IS NULL
+                  AND ({IMPORT_KEY.format(t="a")}) = ({IMPORT_KEY.format(t="s")})
+            """)
+            atualizados = cur.rowcount
+        else:
+            cur.execute(f"""
+                SELECT COUNT(*) AS total FROM alunos a JOIN importacao_alunos s
+                  ON s.motivo IS NULL AND ({IMPORT_KEY.format(t="a")}) = ({IMPORT_KEY.format(t="s")})
+            """)
+            atualizados = cur.fetchone()["total"]
+
+        cur.execute(f"""
+            INSERT INTO alunos ({", ".join(IMPORT_COLUMNS)})
+            SELECT {", ".join(f"COALESCE(s.{c}, '')" for c in IMPORT_COLUMNS)}
+            FROM importacao_alunos s
+            WHERE s.motivo IS NULL AND NOT EXISTS (
+                SELECT 1 FROM alunos a WHERE ({IMPORT_KEY.format(t="a")}) = ({IMPORT_KEY.format(t="s")})
+            )
+        """)
+        inseridos = cur.rowcount
+
+        cur.execute("SELECT COUNT(*) AS total FROM importacao_alunos WHERE motivo IS NOT NULL")
+        rejeitados = cur.fetchone()["total"]
+        cur.execute("""
+            SELECT linha + 1 AS linha, motivo FROM importacao_alunos
+            WHERE motivo IS NOT NULL ORDER BY linha LIMIT %s
+        """, (IMPORT_MAX_ERROS,))
+        erros = cur.fetchall()
+
+        notify(cur, "alunos_recarregar")
+        conn.commit()
+
+    typeahead.invalidate()
+    return {
+        "lidas": lidas,
+        "inseridos": inseridos,
+        "atualizados": atualizados,
+        "rejeitados": rejeitados,
+        "erros": erros,
+    }
+
+
+@app.route("/api/alunos/importar", methods=["POST"])
+@require_auth
+def alunos_importar():
+    """Importa alunos de um CSV (upload multipart `arquivo` ou corpo text/csv)"""
+    if not is_admin():
+        return api_error("Apenas admin pode importar alunos", 403)
+    # com o psycogreen (WORKER_CLASS=gevent) o psycopg2 tem um wait callback e recusa COPY
+    if psycopg2.extensions.get_wait_callback() is not None:
+        return api_error(
+            "Importação indisponível neste servidor (gevent): use `python server.py importar-alunos arquivo.csv`",
+            503,
+        )
+
+    encoding = IMPORT_ENCODINGS.get((request.args.get("encoding") or "utf8").lower())
+    if not encoding:
+        return api_error("encoding não suportado", 400)
+
+    if request.mimetype == "multipart/form-data":
+        arquivo = request.files.get("arquivo")
+        if not arquivo:
+            return api_error("Envie o arquivo no campo 'arquivo'", 400)
+        stream = arquivo.stream
+    else:
+        stream = request.stream
+
+    try:
+        relatorio = importar_alunos(stream, encoding)
+    except ValueError as e:
+        return api_error(str(e), 400)
+    except Exception as e:
+        print("Erro em /api/alunos/importar:", str(e))
+        return api_error("Erro ao importar alunos", 500, e)
+    return jsonify({"ok": True, **relatorio})
+
+
 # ==========================================================
 # EQUIPE CRUD
 # ==========================================================
 @app.route("/api/usuarios", methods=["GET"])
 @require_auth
+@conditional("usuarios")
 def usuarios_list():
     q = (request.args.get("q") or "").strip()
     try:
-        conn = db()
-        cur = conn.cursor()
-        if q:
-            cur.execute("""
-                SELECT id, nome, usuario, role, telefone, email, foto
-                FROM usuarios
-                WHERE nome ILIKE %s OR usuario ILIKE %s
-                ORDER BY nome ASC
-                LIMIT 500
-            """, (f"%{q}%", f"%{q}%"))
-        else:
-            cur.execute("""
-                SELECT id, nome, usuario, role, telefone, email, foto
-                FROM usuarios
-                ORDER BY nome ASC
-                LIMIT 500
-            """)
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return jsonify(rows)
+        page = read_page("usuarios", USUARIOS_KEYS, 500)
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    try:
+        with db() as conn, conn.cursor() as cur:
+            if q:
+                cond, rank, params = search_sql(q)
+                cur.execute(f"""
+                    SELECT id, nome, usuario, role, telefone, email, foto
+                    FROM usuarios
+                    WHERE {cond}
+                    ORDER BY {rank} DESC, COALESCE(nome, ''), id
+                    LIMIT %s
+                """, (*params, page.limit))
+                rows, next_cursor = cur.fetchall(), None
+            else:
+                keys, after, params, order = page_sql(page)
+                cur.execute(f"""
+                    SELECT id, nome, usuario, role, telefone, email, foto, {keys}
+                    FROM usuarios
+                    WHERE {after}
+                    ORDER BY {order}
+                    LIMIT %s
+                """, (*params, page.limit + 1))
+                rows, next_cursor = finish_page(page, cur.fetchall())
+        return page_response(page, with_variant(rows, "foto", "avatar"), next_cursor)
     except Exception as e:
         return api_error("Erro ao listar equipe", 500, e)
 
@@ -518,25 +2675,27 @@ def usuarios_create():
     if not nome or not usuario or not senha:
         return api_error("Nome, usuário e senha são obrigatórios", 400)
 
+    try:
+        foto = store_image(data.get("foto"))
+    except ValueError as e:
+        return api_error(str(e), 400)
+
     payload = (
         nome, usuario, senha, role,
         (data.get("telefone") or "").strip(),
         (data.get("email") or "").strip(),
-        (data.get("foto") or "").strip() or None
+        foto
     )
 
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO usuarios (nome, usuario, senha, role, telefone, email, foto)
-            VALUES (%s,%s,%s,%s,%s,%s,%s)
-            RETURNING id
-        """, payload)
-        new_id = cur.fetchone()["id"]
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO usuarios (nome, usuario, senha, role, telefone, email, foto)
+                VALUES (%s,%s,%s,%s,%s,%s,%s)
+                RETURNING id
+            """, payload)
+            new_id = cur.fetchone()["id"]
+            conn.commit()
         return jsonify({"ok": True, "id": new_id})
     except Exception as e:
         return api_error("Erro ao cadastrar membro", 500, e)
@@ -558,37 +2717,40 @@ def usuarios_update(uid):
         return api_error("Nome e usuário são obrigatórios", 400)
 
     try:
-        conn = db()
-        cur = conn.cursor()
-
-        if senha:
-            cur.execute("""
-                UPDATE usuarios
-                SET nome=%s, usuario=%s, senha=%s, role=%s, telefone=%s, email=%s, foto=%s
-                WHERE id=%s
-            """, (
-                nome, usuario, senha, role,
-                (data.get("telefone") or "").strip(),
-                (data.get("email") or "").strip(),
-                (data.get("foto") or "").strip() or None,
-                uid
-            ))
-        else:
-            cur.execute("""
-                UPDATE usuarios
-                SET nome=%s, usuario=%s, role=%s, telefone=%s, email=%s, foto=%s
-                WHERE id=%s
-            """, (
-                nome, usuario, role,
-                (data.get("telefone") or "").strip(),
-                (data.get("email") or "").strip(),
-                (data.get("foto") or "").strip() or None,
-                uid
-            ))
+        foto = store_image(data.get("foto"))
+    except ValueError as e:
+        return api_error(str(e), 400)
 
-        conn.commit()
-        cur.close()
-        conn.close()
+    try:
+        with db() as conn, conn.cursor() as cur:
+            if senha:
+                cur.execute("""
+                    UPDATE usuarios
+                    SET nome=%s, usuario=%s, senha=%s, role=%s, telefone=%s, email=%s, foto=%s
+                    WHERE id=%s
+                """, (
+                    nome, usuario, senha, role,
+                    (data.get("telefone") or "").strip(),
+                    (data.get("email") or "").strip(),
+                    foto,
+                    uid
+                ))
+            else:
+                cur.execute("""
+                    UPDATE usuarios
+                    SET nome=%s, usuario=%s, role=%s, telefone=%s, email=%s, foto=%s
+                    WHERE id=%s
+                """, (
+                    nome, usuario, role,
+                    (data.get("telefone") or "").strip(),
+                    (data.get("email") or "").strip(),
+                    foto,
+                    uid
+                ))
+
+            notify(cur, "usuario", id=uid)
+            conn.commit()
+        user_directory.invalidate(uid)
         return jsonify({"ok": True})
     except Exception as e:
         return api_error("Erro ao atualizar membro", 500, e)
@@ -604,12 +2766,11 @@ def usuarios_delete(uid):
         return api_error("Você não pode excluir seu próprio usuário", 400)
 
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM usuarios WHERE id=%s", (uid,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM usuarios WHERE id=%s", (uid,))
+            notify(cur, "usuario", id=uid)
+            conn.commit()
+        user_directory.invalidate(uid)
         return jsonify({"ok": True})
     except Exception as e:
         return api_error("Erro ao excluir membro", 500, e)
@@ -620,40 +2781,40 @@ def usuarios_delete(uid):
 # ==========================================================
 @app.route("/api/avisos", methods=["GET"])
 @require_auth
+@conditional("avisos", "avisos_likes")
 def avisos_list():
     uid = request.user["id"]
     try:
-        conn = db()
-        cur = conn.cursor()
-
-        cur.execute("""
-            SELECT id, mensagem, data_criacao, autor, autor_id, imagem, fixado
-            FROM avisos
-            ORDER BY fixado DESC, data_criacao DESC
-            LIMIT 200
-        """)
-        avisos = cur.fetchall()
-
-        cur.execute("SELECT aviso_id, COUNT(*)::int AS likes FROM avisos_likes GROUP BY aviso_id")
-        likes_map = {r["aviso_id"]: r["likes"] for r in cur.fetchall()}
+        page = read_page("avisos", AVISOS_KEYS, 200, desc=True)
+    except ValueError as e:
+        return api_error(str(e), 400)
 
-        cur.execute("SELECT aviso_id, COUNT(*)::int AS comments FROM avisos_comentarios GROUP BY aviso_id")
-        comments_map = {r["aviso_id"]: r["comments"] for r in cur.fetchall()}
-
-        cur.execute("SELECT aviso_id FROM avisos_likes WHERE user_id=%s", (uid,))
-        liked_set = {r["aviso_id"] for r in cur.fetchall()}
-
-        cur.close()
-        conn.close()
+    keys, after, params, order = page_sql(page)
+    try:
+        with db() as conn, conn.cursor() as cur:
+            # contadores vêm das colunas; liked_by_me só é avaliado para a página retornada
+            started = time.perf_counter()
+            cur.execute(f"""
+                SELECT id, mensagem, data_criacao, autor, autor_id, imagem, fixado,
+                       like_count, comment_count,
+                       EXISTS (
+                           SELECT 1 FROM avisos_likes l
+                           WHERE l.aviso_id = avisos.id AND l.user_id = %s
+                       ) AS liked_by_me,
+                       {keys}
+                FROM avisos
+                WHERE {after}
+                ORDER BY {order}
+                LIMIT %s
+            """, (uid, *params, page.limit + 1))
+            avisos, next_cursor = finish_page(page, cur.fetchall())
+            query_ms = (time.perf_counter() - started) * 1000
 
         for a in avisos:
-            a["like_count"] = likes_map.get(a["id"], 0)
-            a["comment_count"] = comments_map.get(a["id"], 0)
-            a["liked_by_me"] = a["id"] in liked_set
-            if a.get("data_criacao"):
-                a["data_criacao"] = a["data_criacao"].isoformat()
+            a["imagem"] = variant_url(a.get("imagem"), "card")
 
-        return jsonify(avisos)
+        resp = page_response(page, avisos, next_cursor)
+        return server_timing(resp, "db", query_ms)
 
     except Exception as e:
         return api_error("Erro ao carregar avisos", 500, e)
@@ -669,25 +2830,27 @@ def avisos_create():
     if not mensagem and not imagem:
         return api_error("Informe mensagem ou imagem", 400)
 
+    try:
+        imagem = store_image(imagem)
+    except ValueError as e:
+        return api_error(str(e), 400)
+
     uid = request.user["id"]
 
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("SELECT nome FROM usuarios WHERE id=%s", (uid,))
-        u = cur.fetchone()
-        autor = (u.get("nome") if u else "Usuário")
+        with db() as conn, conn.cursor() as cur:
+            u = user_directory.get(uid, cur)
+            autor = (u.get("nome") if u else "Usuário")
 
-        cur.execute("""
-            INSERT INTO avisos (mensagem, data_criacao, autor, autor_id, imagem, fixado)
-            VALUES (%s, NOW(), %s, %s, %s, FALSE)
-            RETURNING id
-        """, (mensagem, autor, uid, imagem if imagem else None))
+            cur.execute("""
+                INSERT INTO avisos (mensagem, data_criacao, autor, autor_id, imagem, fixado)
+                VALUES (%s, NOW(), %s, %s, %s, FALSE)
+                RETURNING id
+            """, (mensagem, autor, uid, imagem))
 
-        new_id = cur.fetchone()["id"]
-        conn.commit()
-        cur.close()
-        conn.close()
+            new_id = cur.fetchone()["id"]
+            publish_event(cur, "aviso", id=new_id, acao="novo")
+            conn.commit()
         return jsonify({"ok": True, "id": new_id})
 
     except Exception as e:
@@ -701,20 +2864,16 @@ def avisos_fixar(aviso_id):
         return api_error("Apenas admin", 403)
 
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("SELECT fixado FROM avisos WHERE id=%s", (aviso_id,))
-        row = cur.fetchone()
-        if not row:
-            cur.close()
-            conn.close()
-            return api_error("Aviso não encontrado", 404)
-
-        novo = not bool(row["fixado"])
-        cur.execute("UPDATE avisos SET fixado=%s WHERE id=%s", (novo, aviso_id))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("SELECT fixado FROM avisos WHERE id=%s", (aviso_id,))
+            row = cur.fetchone()
+            if not row:
+                return api_error("Aviso não encontrado", 404)
+
+            novo = not bool(row["fixado"])
+            cur.execute("UPDATE avisos SET fixado=%s WHERE id=%s", (novo, aviso_id))
+            publish_event(cur, "aviso", id=aviso_id, acao="fixado", fixado=novo)
+            conn.commit()
         return jsonify({"ok": True, "fixado": novo})
     except Exception as e:
         return api_error("Erro ao fixar aviso", 500, e)
@@ -727,70 +2886,138 @@ def avisos_delete(aviso_id):
         return api_error("Apenas admin", 403)
 
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM avisos WHERE id=%s", (aviso_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM avisos WHERE id=%s", (aviso_id,))
+            publish_event(cur, "aviso", id=aviso_id, acao="removido")
+            conn.commit()
         return jsonify({"ok": True})
     except Exception as e:
         return api_error("Erro ao excluir aviso", 500, e)
 
 
-@app.route("/api/avisos/<int:aviso_id>/like", methods=["POST"])
-@require_auth
-def aviso_like_toggle(aviso_id):
-    uid = request.user["id"]
+# Um único comando por toque: a linha do aviso é travada (serializa toques simultâneos e
+# dá 404 se o aviso não existe) e o contador anda exatamente o que as linhas andaram.
+LIKE_SQL = {
+    "toggle": """
+        WITH alvo AS (
+            SELECT id FROM avisos WHERE id = %(aviso_id)s FOR UPDATE
+        ),
+        removido AS (
+            DELETE FROM avisos_likes
+            WHERE aviso_id IN (SELECT id FROM alvo) AND user_id = %(uid)s
+            RETURNING 1
+        ),
+        inserido AS (
+            INSERT INTO avisos_likes (aviso_id, user_id)
+            SELECT id, %(uid)s FROM alvo
+            WHERE NOT EXISTS (SELECT 1 FROM removido)
+            ON CONFLICT (aviso_id, user_id) DO NOTHING
+            RETURNING 1
+        ),
+        contador AS (
+            UPDATE avisos
+            SET like_count = like_count + (SELECT COUNT(*) FROM inserido) - (SELECT COUNT(*) FROM removido)
+            WHERE id IN (SELECT id FROM alvo)
+            RETURNING like_count
+        )
+        SELECT NOT EXISTS (SELECT 1 FROM removido) AS liked, like_count FROM contador
+    """,
+    "like": """
+        WITH alvo AS (
+            SELECT id FROM avisos WHERE id = %(aviso_id)s FOR UPDATE
+        ),
+        inserido AS (
+            INSERT INTO avisos_likes (aviso_id, user_id)
+            SELECT id, %(uid)s FROM alvo
+            ON CONFLICT (aviso_id, user_id) DO NOTHING
+            RETURNING 1
+        ),
+        contador AS (
+            UPDATE avisos
+            SET like_count = like_count + (SELECT COUNT(*) FROM inserido)
+            WHERE id IN (SELECT id FROM alvo)
+            RETURNING like_count
+        )
+        SELECT TRUE AS liked, like_count FROM contador
+    """,
+    "unlike": """
+        WITH alvo AS (
+            SELECT id FROM avisos WHERE id = %(aviso_id)s FOR UPDATE
+        ),
+        removido AS (
+            DELETE FROM avisos_likes
+            WHERE aviso_id IN (SELECT id FROM alvo) AND user_id = %(uid)s
+            RETURNING 1
+        ),
+        contador AS (
+            UPDATE avisos
+            SET like_count = like_count - (SELECT COUNT(*) FROM removido)
+            WHERE id IN (SELECT id FROM alvo)
+            RETURNING like_count
+        )
+        SELECT FALSE AS liked, like_count FROM contador
+    """,
+}
 
-    try:
-        conn = db()
-        cur = conn.cursor()
 
-        liked = False
-        try:
-            cur.execute("INSERT INTO avisos_likes (aviso_id, user_id) VALUES (%s, %s)", (aviso_id, uid))
-            conn.commit()
-            liked = True
-        except Exception:
-            conn.rollback()
-            cur.execute("DELETE FROM avisos_likes WHERE aviso_id=%s AND user_id=%s", (aviso_id, uid))
+def set_like(aviso_id, mode):
+    uid = request.user["id"]
+    try:
+        with db() as conn, conn.cursor() as cur:
+            cur.execute(LIKE_SQL[mode], {"aviso_id": aviso_id, "uid": uid})
+            row = cur.fetchone()
+            if not row:
+                return api_error("Aviso não encontrado", 404)
+            publish_event(cur, "aviso", id=aviso_id, acao="likes", like_count=row["like_count"])
             conn.commit()
-            liked = False
+        return jsonify({"ok": True, "liked": row["liked"], "like_count": row["like_count"]})
 
-        cur.execute("SELECT COUNT(*)::int AS total FROM avisos_likes WHERE aviso_id=%s", (aviso_id,))
-        total = cur.fetchone()["total"]
+    except Exception as e:
+        return api_error("Erro ao processar like", 500, e)
 
-        cur.close()
-        conn.close()
 
-        return jsonify({"ok": True, "liked": liked, "like_count": total})
+@app.route("/api/avisos/<int:aviso_id>/like", methods=["POST"])
+@require_auth
+def aviso_like_toggle(aviso_id):
+    return set_like(aviso_id, "toggle")
+
 
-    except Exception as e:
-        return api_error("Erro ao processar like", 500, e)
+@app.route("/api/avisos/<int:aviso_id>/like", methods=["PUT"])
+@require_auth
+def aviso_like_put(aviso_id):
+    """Curte (idempotente: repetir não muda nada)"""
+    return set_like(aviso_id, "like")
+
+
+@app.route("/api/avisos/<int:aviso_id>/like", methods=["DELETE"])
+@require_auth
+def aviso_like_delete(aviso_id):
+    """Descurte (idempotente)"""
+    return set_like(aviso_id, "unlike")
 
 
 @app.route("/api/avisos/<int:aviso_id>/comentarios", methods=["GET"])
 @require_auth
+@conditional("avisos_comentarios")
 def comentarios_list(aviso_id):
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT id, aviso_id, user_id, user_nome, texto, created_at
-            FROM avisos_comentarios
-            WHERE aviso_id=%s
-            ORDER BY created_at ASC
-            LIMIT 300
-        """, (aviso_id,))
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
+        page = read_page("comentarios", COMENTARIOS_KEYS, 300)
+    except ValueError as e:
+        return api_error(str(e), 400)
 
-        for r in rows:
-            if r.get("created_at"):
-                r["created_at"] = r["created_at"].isoformat()
-        return jsonify(rows)
+    keys, after, params, order = page_sql(page)
+    try:
+        with db() as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT id, aviso_id, user_id, user_nome, texto, created_at, {keys}
+                FROM avisos_comentarios
+                WHERE aviso_id=%s AND {after}
+                ORDER BY {order}
+                LIMIT %s
+            """, (aviso_id, *params, page.limit + 1))
+            rows, next_cursor = finish_page(page, cur.fetchall())
+
+        return page_response(page, rows, next_cursor)
 
     except Exception as e:
         return api_error("Erro ao carregar comentários", 500, e)
@@ -807,22 +3034,25 @@ def comentarios_create(aviso_id):
     uid = request.user["id"]
 
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute("SELECT nome FROM usuarios WHERE id=%s", (uid,))
-        u = cur.fetchone()
-        nome = (u.get("nome") if u else "Usuário")
+        with db() as conn, conn.cursor() as cur:
+            u = user_directory.get(uid, cur)
+            nome = (u.get("nome") if u else "Usuário")
 
-        cur.execute("""
-            INSERT INTO avisos_comentarios (aviso_id, user_id, user_nome, texto)
-            VALUES (%s, %s, %s, %s)
-            RETURNING id
-        """, (aviso_id, uid, nome, texto))
+            cur.execute("""
+                INSERT INTO avisos_comentarios (aviso_id, user_id, user_nome, texto)
+                VALUES (%s, %s, %s, %s)
+                RETURNING id
+            """, (aviso_id, uid, nome, texto))
 
-        cid = cur.fetchone()["id"]
-        conn.commit()
-        cur.close()
-        conn.close()
+            cid = cur.fetchone()["id"]
+            cur.execute("""
+                UPDATE avisos SET comment_count = comment_count + 1 WHERE id=%s RETURNING comment_count
+            """, (aviso_id,))
+            contador = cur.fetchone()
+            if contador:
+                publish_event(cur, "aviso", id=aviso_id, acao="comentarios",
+                              comment_count=contador["comment_count"])
+            conn.commit()
 
         return jsonify({"ok": True, "id": cid})
 
@@ -836,25 +3066,26 @@ def comentarios_delete(comentario_id):
     uid = request.user["id"]
 
     try:
-        conn = db()
-        cur = conn.cursor()
-
-        cur.execute("SELECT user_id FROM avisos_comentarios WHERE id=%s", (comentario_id,))
-        row = cur.fetchone()
-        if not row:
-            cur.close()
-            conn.close()
-            return api_error("Comentário não encontrado", 404)
-
-        if (row["user_id"] != uid) and (not is_admin()):
-            cur.close()
-            conn.close()
-            return api_error("Sem permissão", 403)
-
-        cur.execute("DELETE FROM avisos_comentarios WHERE id=%s", (comentario_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("SELECT user_id FROM avisos_comentarios WHERE id=%s", (comentario_id,))
+            row = cur.fetchone()
+            if not row:
+                return api_error("Comentário não encontrado", 404)
+
+            if (row["user_id"] != uid) and (not is_admin(cur)):
+                return api_error("Sem permissão", 403)
+
+            cur.execute("DELETE FROM avisos_comentarios WHERE id=%s RETURNING aviso_id", (comentario_id,))
+            deleted = cur.fetchone()
+            if deleted:
+                cur.execute("""
+                    UPDATE avisos SET comment_count = comment_count - 1 WHERE id=%s RETURNING comment_count
+                """, (deleted["aviso_id"],))
+                contador = cur.fetchone()
+                if contador:
+                    publish_event(cur, "aviso", id=deleted["aviso_id"], acao="comentarios",
+                                  comment_count=contador["comment_count"])
+            conn.commit()
         return jsonify({"ok": True})
 
     except Exception as e:
@@ -864,28 +3095,45 @@ def comentarios_delete(comentario_id):
 # ==========================================================
 # AULAS 
 # ==========================================================
+def contar_presencas(cur, aula_id, entradas=0, saidas=0):
+    """Ajusta as contagens da aula na mesma transação do check-in/saída"""
+    if entradas or saidas:
+        cur.execute(
+            "UPDATE aulas SET total_criancas = total_criancas + %s, total_saidas = total_saidas + %s WHERE id = %s",
+            (entradas, saidas, aula_id),
+        )
+
+
+def travar_aula_aberta(cur, aula_id):
+    """Trava a linha da aula para um check-in; devolve o motivo da recusa ou None se está aberta.
+
+    Com a trava, um encerramento simultâneo espera o check-in (e conta a criança) ou
+    o check-in vê a aula já encerrada.
+    """
+    cur.execute("SELECT encerrada_em FROM aulas WHERE id = %s FOR NO KEY UPDATE", (aula_id,))
+    row = cur.fetchone()
+    if not row:
+        return "Aula não encontrada"
+    if row["encerrada_em"] is not None:
+        return "Aula encerrada"
+    return None
+
+
+def fechar_contagem(cur, aula_id):
+    """Recalcula as contagens a partir de frequencia ao encerrar; o histórico lê só esses números"""
+    cur.execute(f"UPDATE aulas a SET {AULA_CONTAGEM_SET} WHERE a.id = %s", (aula_id,))
+
+
 @app.get("/api/aulas/ativa")
 @require_auth
 def aulas_ativa():
     """Retorna a aula ativa (encerrada_em IS NULL) mais recente"""
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT id, data_aula, tema, professores, encerrada_em FROM aulas WHERE encerrada_em IS NULL ORDER BY data_aula DESC LIMIT 1"
-        )
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
+        row = get_aula_ativa()
         
         if not row:
             return jsonify({"ok": True, "aula": None})
             
-        if row.get("data_aula"):
-            row["data_aula"] = row["data_aula"].isoformat()
-        if row.get("encerrada_em"):
-            row["encerrada_em"] = row["encerrada_em"].isoformat()
-            
         return jsonify({"ok": True, "aula": row})
     except Exception as e:
         print("Erro em /api/aulas/ativa:", str(e))
@@ -911,21 +3159,23 @@ def aulas_iniciar():
         if auxiliar and auxiliar.lower() != "nenhum":
             professores = f"{professor} / Aux: {auxiliar}"
 
-        conn = db()
-        cur = conn.cursor()
-        
-        cur.execute("UPDATE aulas SET encerrada_em = NOW() WHERE encerrada_em IS NULL")
-        
-        cur.execute(
-            "INSERT INTO aulas (data_aula, tema, professores) VALUES (NOW(), %s, %s) RETURNING id",
-            (tema, professores),
-        )
-        result = cur.fetchone()
-        aula_id = result["id"] if result else None
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("UPDATE aulas SET encerrada_em = NOW() WHERE encerrada_em IS NULL RETURNING id")
+            for encerrada in cur.fetchall():
+                fechar_contagem(cur, encerrada["id"])
+                analytics_processar_aula(cur, encerrada["id"])
+            
+            cur.execute(
+                "INSERT INTO aulas (data_aula, tema, professores) VALUES (NOW(), %s, %s) RETURNING id",
+                (tema, professores),
+            )
+            result = cur.fetchone()
+            aula_id = result["id"] if result else None
+            publish_event(cur, "aula", acao="iniciada", aula_id=aula_id)
+            notify(cur, "aula_ativa")
+            
+            conn.commit()
+        invalidate_aula_ativa()
         
         return jsonify({"ok": True, "aula_id": aula_id})
     except Exception as e:
@@ -941,18 +3191,22 @@ def aulas_encerrar():
         body = request.get_json(force=True, silent=True) or {}
         aula_id = body.get("aula_id")
         
-        conn = db()
-        cur = conn.cursor()
-        
-        if aula_id:
-            cur.execute("UPDATE aulas SET encerrada_em = NOW() WHERE id=%s RETURNING id", (aula_id,))
-        else:
-            cur.execute("UPDATE aulas SET encerrada_em = NOW() WHERE encerrada_em IS NULL RETURNING id")
-            
-        row = cur.fetchone()
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            if aula_id:
+                cur.execute("UPDATE aulas SET encerrada_em = NOW() WHERE id=%s RETURNING id", (aula_id,))
+            else:
+                cur.execute("UPDATE aulas SET encerrada_em = NOW() WHERE encerrada_em IS NULL RETURNING id")
+                
+            rows = cur.fetchall()
+            row = rows[0] if rows else None
+            for r in rows:
+                fechar_contagem(cur, r["id"])
+                analytics_processar_aula(cur, r["id"])
+            if row:
+                publish_event(cur, "aula", acao="encerrada", aula_id=row["id"])
+                notify(cur, "aula_ativa")
+            conn.commit()
+        invalidate_aula_ativa()
         
         return jsonify({"ok": True, "aula_id": row["id"] if row else None})
     except Exception as e:
@@ -962,51 +3216,40 @@ def aulas_encerrar():
 
 @app.get("/api/aulas/presentes")
 @require_auth
+@conditional("aulas", "frequencia", "alunos")
 def aulas_presentes():
     """Lista os presentes em uma aula"""
     try:
         aula_id = request.args.get("aula_id")
-        
-        if not aula_id:
-            conn = db()
-            cur = conn.cursor()
-            cur.execute("SELECT id FROM aulas WHERE encerrada_em IS NULL ORDER BY data_aula DESC LIMIT 1")
-            r = cur.fetchone()
-            cur.close()
-            conn.close()
-            
-            if r:
-                aula_id = r["id"]
-            else:
-                return jsonify({"ok": True, "aula_id": None, "presentes": []})
 
-        try:
-            aula_id = int(aula_id)
-        except (TypeError, ValueError):
-            return jsonify({"ok": True, "aula_id": None, "presentes": []})
+        with db() as conn, conn.cursor() as cur:
+            if not aula_id:
+                r = get_aula_ativa(cur)
+                
+                if r:
+                    aula_id = r["id"]
+                else:
+                    return jsonify({"ok": True, "aula_id": None, "presentes": []})
+
+            try:
+                aula_id = int(aula_id)
+            except (TypeError, ValueError):
+                return jsonify({"ok": True, "aula_id": None, "presentes": []})
 
-        conn = db()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT f.id AS frequencia_id, a.id AS aluno_id, a.nome,
-                   f.horario_entrada, f.horario_saida, f.retirado_por
-            FROM frequencia f
-            JOIN alunos a ON a.id = f.id_aluno
-            WHERE f.id_aula = %s
-            ORDER BY a.nome ASC
-            """,
-            (aula_id,),
-        )
-        presentes = cur.fetchall()
-        cur.close()
-        conn.close()
+            cur.execute(
+                """
+                SELECT f.id AS frequencia_id, a.id AS aluno_id, a.nome, a.foto,
+                       f.horario_entrada, f.horario_saida, f.retirado_por
+                FROM frequencia f
+                JOIN alunos a ON a.id = f.id_aluno
+                WHERE f.id_aula = %s
+                ORDER BY a.nome ASC
+                """,
+                (aula_id,),
+            )
+            presentes = cur.fetchall()
         
-        for p in presentes:
-            if p.get("horario_entrada"):
-                p["horario_entrada"] = p["horario_entrada"].isoformat()
-            if p.get("horario_saida"):
-                p["horario_saida"] = p["horario_saida"].isoformat()
+        with_variant(presentes, "foto", "avatar")
         
         return jsonify({"ok": True, "aula_id": aula_id, "presentes": presentes})
     except Exception as e:
@@ -1026,35 +3269,38 @@ def aulas_entrada():
         if not aluno_id:
             return api_error("aluno_id é obrigatório", 400)
 
-        if not aula_id:
-            conn = db()
-            cur = conn.cursor()
-            cur.execute("SELECT id FROM aulas WHERE encerrada_em IS NULL ORDER BY data_aula DESC LIMIT 1")
-            r = cur.fetchone()
-            cur.close()
-            conn.close()
+        with db() as conn, conn.cursor() as cur:
+            if not aula_id:
+                r = get_aula_ativa(cur)
+                
+                if not r:
+                    return api_error("Não há aula ativa", 400)
+                aula_id = r["id"]
+            recusa = travar_aula_aberta(cur, aula_id)
+            if recusa:
+                return api_error(recusa, 400)
+
+            cur.execute(
+                """
+                WITH novo AS (
+                    INSERT INTO frequencia (id_aula, id_aluno, horario_entrada)
+                    VALUES (%s, %s, NOW())
+                    ON CONFLICT (id_aula, id_aluno) DO NOTHING
+                    RETURNING id, id_aula, id_aluno, horario_entrada
+                )
+                SELECT novo.id, novo.id_aula, novo.id_aluno, novo.horario_entrada, a.nome
+                FROM novo JOIN alunos a ON a.id = novo.id_aluno
+                """,
+                (aula_id, aluno_id),
+            )
             
-            if not r:
-                return api_error("Não há aula ativa", 400)
-            aula_id = r["id"]
-
-        conn = db()
-        cur = conn.cursor()
-        
-        cur.execute(
-            """
-            INSERT INTO frequencia (id_aula, id_aluno, horario_entrada)
-            VALUES (%s, %s, NOW())
-            ON CONFLICT (id_aula, id_aluno) DO NOTHING
-            RETURNING id
-            """,
-            (aula_id, aluno_id),
-        )
-        
-        result = cur.fetchone()
-        conn.commit()
-        cur.close()
-        conn.close()
+            result = cur.fetchone()
+            if result:
+                contar_presencas(cur, result["id_aula"], entradas=1)
+                publish_event(cur, "checkin", aula_id=result["id_aula"], frequencia_id=result["id"],
+                              aluno_id=result["id_aluno"], nome=result["nome"],
+                              horario_entrada=result["horario_entrada"])
+            conn.commit()
         
         return jsonify({
             "ok": True, 
@@ -1081,17 +3327,30 @@ def aulas_saida():
         if not retirado_por:
             return api_error("retirado_por é obrigatório", 400)
 
-        conn = db()
-        cur = conn.cursor()
-        
-        cur.execute(
-            "UPDATE frequencia SET horario_saida = NOW(), retirado_por = %s WHERE id = %s",
-            (retirado_por, frequencia_id),
-        )
-        
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            # trava a linha antes de decidir se é a primeira saída: duas saídas simultâneas
+            # da mesma criança contariam duas vezes lendo o estado anterior do snapshot
+            cur.execute("SELECT horario_saida FROM frequencia WHERE id = %s FOR UPDATE", (frequencia_id,))
+            antes = cur.fetchone()
+            row = None
+            if antes:
+                cur.execute(
+                    """
+                    UPDATE frequencia SET horario_saida = NOW(), retirado_por = %s
+                    WHERE id = %s
+                    RETURNING id, id_aula, id_aluno, horario_saida, retirado_por
+                    """,
+                    (retirado_por, frequencia_id),
+                )
+                row = cur.fetchone()
+            if row:
+                if antes["horario_saida"] is None:
+                    contar_presencas(cur, row["id_aula"], saidas=1)
+                publish_event(cur, "checkout", aula_id=row["id_aula"], frequencia_id=row["id"],
+                              aluno_id=row["id_aluno"], horario_saida=row["horario_saida"],
+                              retirado_por=row["retirado_por"])
+            
+            conn.commit()
         
         return jsonify({"ok": True})
     except Exception as e:
@@ -1099,34 +3358,238 @@ def aulas_saida():
         return api_error("Erro ao registrar saída", 500, e)
 
 
+LOTE_MAX = int(os.getenv("LOTE_MAX", "100"))
+
+
+def int_list(values):
+    """Lista de inteiros sem repetição, na ordem recebida; ValueError se algum não for inteiro."""
+    if not isinstance(values, list):
+        raise ValueError("lista esperada")
+    out = []
+    for v in values:
+        if isinstance(v, bool):
+            raise ValueError("id inválido")
+        try:
+            n = int(v)
+        except (TypeError, ValueError):
+            raise ValueError("id inválido")
+        if n not in out:
+            out.append(n)
+    return out
+
+
+@app.post("/api/aulas/entrada/lote")
+@require_auth
+def aulas_entrada_lote():
+    """Registra a entrada de vários alunos (ou de todos os filhos de um responsável) de uma vez"""
+    try:
+        body = request.get_json(force=True, silent=True) or {}
+        aula_id = body.get("aula_id")
+        responsavel = (body.get("responsavel") or "").strip()
+        try:
+            aluno_ids = int_list(body.get("aluno_ids") or [])
+        except ValueError:
+            return api_error("aluno_ids deve ser uma lista de ids", 400)
+
+        if not aluno_ids and not responsavel:
+            return api_error("Informe aluno_ids ou responsavel", 400)
+        if len(aluno_ids) > LOTE_MAX:
+            return api_error(f"Máximo de {LOTE_MAX} alunos por lote", 400)
+
+        with db() as conn, conn.cursor() as cur:
+            if not aula_id:
+                r = get_aula_ativa(cur)
+                if not r:
+                    return api_error("Não há aula ativa", 400)
+                aula_id = r["id"]
+            recusa = travar_aula_aberta(cur, aula_id)
+            if recusa:
+                return api_error(recusa, 400)
+
+            if responsavel:
+                cur.execute("""
+                    SELECT id FROM alunos
+                    WHERE busca_normalizada(responsavel) = busca_normalizada(%s)
+                    ORDER BY nome
+                    LIMIT %s
+                """, (responsavel, LOTE_MAX))
+                for r in cur.fetchall():
+                    if r["id"] not in aluno_ids:
+                        aluno_ids.append(r["id"])
+                if not aluno_ids:
+                    return api_error("Nenhum aluno encontrado para esse responsável", 404)
+
+            # um INSERT multi-linha; quem já tinha entrada aparece pela junção com o snapshot anterior
+            cur.execute(
+                """
+                WITH pedidos AS (
+                    SELECT id_aluno, ord FROM unnest(%s::int[]) WITH ORDINALITY AS p(id_aluno, ord)
+                ),
+                novos AS (
+                    INSERT INTO frequencia (id_aula, id_aluno, horario_entrada)
+                    SELECT %s, p.id_aluno, NOW()
+                    FROM pedidos p JOIN alunos a ON a.id = p.id_aluno
+                    ON CONFLICT (id_aula, id_aluno) DO NOTHING
+                    RETURNING id, id_aluno, horario_entrada
+                )
+                SELECT p.id_aluno, a.nome,
+                       COALESCE(n.id, f.id) AS frequencia_id,
+                       n.horario_entrada,
+                       CASE WHEN a.id IS NULL THEN 'nao_encontrado'
+                            WHEN n.id IS NOT NULL THEN 'registrado'
+                            ELSE 'ja_presente' END AS status
+                FROM pedidos p
+                LEFT JOIN alunos a ON a.id = p.id_aluno
+                LEFT JOIN novos n ON n.id_aluno = p.id_aluno
+                LEFT JOIN frequencia f ON f.id_aula = %s AND f.id_aluno = p.id_aluno
+                ORDER BY p.ord
+                """,
+                (aluno_ids, aula_id, aula_id),
+            )
+            resultados = cur.fetchall()
+
+            contar_presencas(cur, aula_id, entradas=sum(r["status"] == "registrado" for r in resultados))
+            for r in resultados:
+                if r["status"] == "registrado":
+                    publish_event(cur, "checkin", aula_id=int(aula_id), frequencia_id=r["frequencia_id"],
+                                  aluno_id=r["id_aluno"], nome=r["nome"],
+                                  horario_entrada=r["horario_entrada"])
+            conn.commit()
+
+        return jsonify({
+            "ok": True,
+            "aula_id": int(aula_id),
+            "resultados": [
+                {"aluno_id": r["id_aluno"], "nome": r["nome"], "status": r["status"],
+                 "frequencia_id": r["frequencia_id"]}
+                for r in resultados
+            ],
+        })
+    except Exception as e:
+        print("Erro em /api/aulas/entrada/lote:", str(e))
+        return api_error("Erro ao dar entrada em lote", 500, e)
+
+
+@app.post("/api/aulas/saida/lote")
+@require_auth
+def aulas_saida_lote():
+    """Registra a saída de vários alunos de uma vez (ex.: turma dispensada junta)
+
+    Aceita `itens: [{frequencia_id, retirado_por}]` ou `frequencia_ids` com um `retirado_por` comum.
+    Saídas já registradas não são sobrescritas.
+    """
+    try:
+        body = request.get_json(force=True, silent=True) or {}
+        padrao = (body.get("retirado_por") or "").strip()
+
+        itens = body.get("itens")
+        if itens is None:
+            try:
+                itens = [{"frequencia_id": fid, "retirado_por": padrao} for fid in int_list(body.get("frequencia_ids") or [])]
+            except ValueError:
+                return api_error("frequencia_ids deve ser uma lista de ids", 400)
+        if not isinstance(itens, list) or not itens:
+            return api_error("Informe itens ou frequencia_ids", 400)
+        if len(itens) > LOTE_MAX:
+            return api_error(f"Máximo de {LOTE_MAX} saídas por lote", 400)
+
+        validos = {}
+        # na ordem do pedido: o resultado já pronto (item inválido) ou o frequencia_id
+        ordem = []
+        for item in itens:
+            item = item if isinstance(item, dict) else {}
+            try:
+                fid = int(item.get("frequencia_id"))
+            except (TypeError, ValueError):
+                ordem.append({"frequencia_id": item.get("frequencia_id"), "status": "invalido"})
+                continue
+            quem = (item.get("retirado_por") or padrao).strip()
+            if not quem:
+                ordem.append({"frequencia_id": fid, "status": "sem_retirado_por"})
+                continue
+            if fid not in validos:
+                validos[fid] = quem
+                ordem.append(fid)
+
+        atualizados = {}
+        existentes = set()
+        if validos:
+            with db() as conn, conn.cursor() as cur:
+                rows = execute_values(
+                    cur,
+                    """
+                    UPDATE frequencia f
+                    SET horario_saida = NOW(), retirado_por = v.retirado_por
+                    FROM (VALUES %s) AS v(id, retirado_por)
+                    WHERE f.id = v.id AND f.horario_saida IS NULL
+                    RETURNING f.id, f.id_aula, f.id_aluno, f.horario_saida, f.retirado_por
+                    """,
+                    list(validos.items()),
+                    template="(%s::int, %s::text)",
+                    fetch=True,
+                )
+                por_aula = {}
+                for row in rows:
+                    por_aula[row["id_aula"]] = por_aula.get(row["id_aula"], 0) + 1
+                for id_aula, n in sorted(por_aula.items()):
+                    contar_presencas(cur, id_aula, saidas=n)
+                for row in rows:
+                    atualizados[row["id"]] = row
+                    publish_event(cur, "checkout", aula_id=row["id_aula"], frequencia_id=row["id"],
+                                  aluno_id=row["id_aluno"], horario_saida=row["horario_saida"],
+                                  retirado_por=row["retirado_por"])
+
+                pendentes = [fid for fid in validos if fid not in atualizados]
+                if pendentes:
+                    cur.execute("SELECT id FROM frequencia WHERE id = ANY(%s)", (pendentes,))
+                    existentes = {r["id"] for r in cur.fetchall()}
+                conn.commit()
+
+        resultados = []
+        for fid in ordem:
+            if isinstance(fid, dict):
+                resultados.append(fid)
+            elif fid in atualizados:
+                resultados.append({"frequencia_id": fid, "status": "registrado",
+                                   "aluno_id": atualizados[fid]["id_aluno"]})
+            elif fid in existentes:
+                resultados.append({"frequencia_id": fid, "status": "ja_saiu"})
+            else:
+                resultados.append({"frequencia_id": fid, "status": "nao_encontrado"})
+
+        return jsonify({"ok": True, "resultados": resultados})
+    except Exception as e:
+        print("Erro em /api/aulas/saida/lote:", str(e))
+        return api_error("Erro ao registrar saídas em lote", 500, e)
+
+
 @app.get("/api/historico")
 @require_auth
+@conditional("aulas")
 def historico_listar():
     """Lista histórico de aulas encerradas"""
     try:
-        conn = db()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT a.id, a.data_aula, a.tema, a.professores,
-                   COUNT(f.id) AS total_criancas
-            FROM aulas a
-            LEFT JOIN frequencia f ON f.id_aula = a.id
-            WHERE a.encerrada_em IS NOT NULL
-            GROUP BY a.id
-            ORDER BY a.data_aula DESC
-            LIMIT 200
-            """
-        )
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        
-        for r in rows:
-            if r.get("data_aula"):
-                r["data_aula"] = r["data_aula"].isoformat()
+        page = read_page("historico", HISTORICO_KEYS, 200, desc=True)
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    keys, after, params, order = page_sql(page)
+    try:
+        with db() as conn, conn.cursor() as cur:
+            cur.execute(
+                f"""
+                SELECT a.id, a.data_aula, a.tema, a.professores,
+                       a.total_criancas, a.total_saidas, {keys}
+                FROM aulas a
+                WHERE a.encerrada_em IS NOT NULL AND {after}
+                ORDER BY {order}
+                LIMIT %s
+                """,
+                (*params, page.limit + 1),
+            )
+            rows, next_cursor = finish_page(page, cur.fetchall())
         
-        return jsonify({"ok": True, "historico": rows})
+        return jsonify({"ok": True, "historico": rows, "next_cursor": next_cursor})
     except Exception as e:
         print("Erro em /api/historico:", str(e))
         return api_error("Erro ao listar histórico", 500, e)
@@ -1134,43 +3597,28 @@ def historico_listar():
 
 @app.get("/api/historico/<int:aula_id>")
 @require_auth
+@conditional("aulas", "frequencia", "alunos")
 def historico_detalhe(aula_id):
     """Detalhes de uma aula específica"""
     try:
-        conn = db()
-        cur = conn.cursor()
-        
-        cur.execute("SELECT id, data_aula, tema, professores FROM aulas WHERE id=%s", (aula_id,))
-        aula = cur.fetchone()
-        
-        if not aula:
-            cur.close()
-            conn.close()
-            return api_error("Aula não encontrada", 404)
-        
-        if aula.get("data_aula"):
-            aula["data_aula"] = aula["data_aula"].isoformat()
-
-        cur.execute(
-            """
-            SELECT a.id AS aluno_id, a.nome, f.horario_entrada, f.horario_saida, f.retirado_por
-            FROM frequencia f
-            JOIN alunos a ON a.id = f.id_aluno
-            WHERE f.id_aula = %s
-            ORDER BY a.nome
-            """,
-            (aula_id,),
-        )
-        presencas = cur.fetchall()
-        
-        for p in presencas:
-            if p.get("horario_entrada"):
-                p["horario_entrada"] = p["horario_entrada"].isoformat()
-            if p.get("horario_saida"):
-                p["horario_saida"] = p["horario_saida"].isoformat()
-        
-        cur.close()
-        conn.close()
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("SELECT id, data_aula, tema, professores FROM aulas WHERE id=%s", (aula_id,))
+            aula = cur.fetchone()
+            
+            if not aula:
+                return api_error("Aula não encontrada", 404)
+
+            cur.execute(
+                """
+                SELECT a.id AS aluno_id, a.nome, f.horario_entrada, f.horario_saida, f.retirado_por
+                FROM frequencia f
+                JOIN alunos a ON a.id = f.id_aluno
+                WHERE f.id_aula = %s
+                ORDER BY a.nome
+                """,
+                (aula_id,),
+            )
+            presencas = cur.fetchall()
         
         return jsonify({"ok": True, "aula": aula, "presencas": presencas})
     except Exception as e:
@@ -1178,10 +3626,507 @@ def historico_detalhe(aula_id):
         return api_error("Erro ao buscar detalhes", 500, e)
 
 
+EXPORT_ITERSIZE = int(os.getenv("EXPORT_ITERSIZE", "2000"))
+EXPORT_COLUMNS = ("aula_id", "data_aula", "tema", "professores", "aluno_id", "aluno_nome",
+                  "horario_entrada", "horario_saida", "retirado_por")
+
+
+def export_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def export_aula(rows):
+    """Agrupa as linhas de uma aula num objeto só (formato NDJSON)"""
+    first = rows[0]
+    return {
+        "id": first["aula_id"],
+        "data_aula": first["data_aula"],
+        "tema": first["tema"],
+        "professores": first["professores"],
+        "presencas": [
+            {
+                "aluno_id": r["aluno_id"],
+                "nome": r["aluno_nome"],
+                "horario_entrada": r["horario_entrada"],
+                "horario_saida": r["horario_saida"],
+                "retirado_por": r["retirado_por"],
+            }
+            for r in rows if r["aluno_id"] is not None
+        ],
+    }
+
+
+@app.get("/api/historico/export")
+@require_auth
+def historico_export():
+    """Exporta aulas encerradas com as presenças em CSV ou NDJSON, em streaming
+
+    Filtros: ?de=AAAA-MM-DD&ate=AAAA-MM-DD&aluno_id=N&formato=csv|ndjson
+    """
+    formato = (request.args.get("formato") or "csv").lower()
+    if formato not in ("csv", "ndjson"):
+        return api_error("formato deve ser csv ou ndjson", 400)
+
+    where, params = ["au.encerrada_em IS NOT NULL"], []
+    try:
+        # filtros na expressão do aulas_historico_idx, para virarem limites da varredura
+        if request.args.get("de"):
+            where.append(f"COALESCE(au.data_aula, {EPOCH}) >= %s")
+            params.append(datetime.strptime(request.args["de"], "%Y-%m-%d"))
+        if request.args.get("ate"):
+            where.append(f"COALESCE(au.data_aula, {EPOCH}) < %s::timestamp + INTERVAL '1 day'")
+            where.append("au.data_aula IS NOT NULL")
+            params.append(datetime.strptime(request.args["ate"], "%Y-%m-%d"))
+        aluno_id = int(request.args["aluno_id"]) if request.args.get("aluno_id") else None
+    except ValueError:
+        return api_error("Filtros inválidos (datas em AAAA-MM-DD, aluno_id numérico)", 400)
+
+    if aluno_id is not None:
+        join = "JOIN frequencia f ON f.id_aula = au.id AND f.id_aluno = %s"
+        params.insert(0, aluno_id)
+    else:
+        join = "LEFT JOIN frequencia f ON f.id_aula = au.id"
+
+    # a ordem do aulas_historico_idx (lido de trás para frente): as aulas saem do índice já
+    # ordenadas e só as presenças de cada aula são ordenadas por nome (Incremental Sort)
+    sql = f"""
+        SELECT au.id AS aula_id, au.data_aula, au.tema, au.professores,
+               al.id AS aluno_id, al.nome AS aluno_nome,
+               f.horario_entrada, f.horario_saida, f.retirado_por
+        FROM aulas au
+        {join}
+        LEFT JOIN alunos al ON al.id = f.id_aluno
+        WHERE {" AND ".join(where)}
+        ORDER BY COALESCE(au.data_aula, {EPOCH}), au.id, al.nome
+    """
+
+    def stream():
+        # cursor nomeado: o Postgres entrega EXPORT_ITERSIZE linhas por vez,
+        # então a memória fica constante e os primeiros bytes saem antes do fim da query
+        with db() as conn, conn.cursor(name="historico_export") as cur:
+            cur.itersize = EXPORT_ITERSIZE
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            if formato == "csv":
+                writer.writerow(EXPORT_COLUMNS)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            cur.execute(sql, params)
+
+            if formato == "csv":
+                n = 0
+                for row in cur:
+                    writer.writerow([export_value(row[c]) for c in EXPORT_COLUMNS])
+                    n += 1
+                    if n % EXPORT_ITERSIZE == 0:
+                        yield buf.getvalue()
+                        buf.seek(0)
+                        buf.truncate()
+                if n % EXPORT_ITERSIZE:
+                    yield buf.getvalue()
+            else:
+                atual = []
+                for row in cur:
+                    if atual and row["aula_id"] != atual[0]["aula_id"]:
+                        yield app.json.dumps(export_aula(atual)) + "\n"
+                        atual = []
+                    atual.append(row)
+                if atual:
+                    yield app.json.dumps(export_aula(atual)) + "\n"
+
+    chunks = stream()
+    # já pega a conexão antes de responder: falha de pool vira erro HTTP, não stream cortado
+    try:
+        first = next(chunks)
+    except Exception as e:
+        print("Erro em /api/historico/export:", str(e))
+        return api_error("Erro ao exportar histórico", 500, e)
+    body = (c for part in ([first], chunks) for c in part)
+
+    ext = "csv" if formato == "csv" else "ndjson"
+    resp = Response(body, mimetype="text/csv" if formato == "csv" else "application/x-ndjson", headers={
+        "Content-Disposition": f'attachment; filename="historico.{ext}"',
+        "X-Accel-Buffering": "no",
+        "Cache-Control": "no-store",
+    })
+    resp.call_on_close(chunks.close)
+    return resp
+
+
+# ==========================================================
+# ANALYTICS
+# ==========================================================
+ANALYTICS_LIMIT_MAX = 500
+# "Prof. Ana / Aux: João" -> professor e auxiliar
+AULA_PROFESSORES_SQL = """
+    SELECT btrim(split_part(professores, ' / Aux: ', 1)) AS professor, 'professor' AS papel FROM aulas WHERE id = %(aula)s
+    UNION ALL
+    SELECT btrim(split_part(professores, ' / Aux: ', 2)), 'auxiliar' FROM aulas WHERE id = %(aula)s
+"""
+
+
+def analytics_processar_aula(cur, aula_id):
+    """Soma uma aula encerrada nos agregados, dentro da transação de quem encerrou.
+
+    Cada aula entra uma vez só (analytics_aulas_processadas); o custo é proporcional
+    às presenças da aula e aos alunos acompanhados, nunca ao histórico inteiro.
+    """
+    cur.execute(
+        "INSERT INTO analytics_aulas_processadas (aula_id) VALUES (%s) ON CONFLICT DO NOTHING RETURNING aula_id",
+        (aula_id,),
+    )
+    if not cur.fetchone():
+        return
+    p = {"aula": aula_id}
+
+    cur.execute("""
+        INSERT INTO analytics_mensal (mes, aulas, presencas)
+        SELECT date_trunc('month', COALESCE(data_aula, NOW()))::date, 1,
+               (SELECT COUNT(*) FROM frequencia WHERE id_aula = %(aula)s)
+        FROM aulas WHERE id = %(aula)s
+        ON CONFLICT (mes) DO UPDATE SET
+            aulas = analytics_mensal.aulas + 1,
+            presencas = analytics_mensal.presencas + EXCLUDED.presencas
+    """, p)
+
+    cur.execute(f"""
+        INSERT INTO analytics_professores (professor, papel, aulas, presencas)
+        SELECT professor, papel, 1, (SELECT COUNT(*) FROM frequencia WHERE id_aula = %(aula)s)
+        FROM ({AULA_PROFESSORES_SQL}) p
+        WHERE professor <> ''
+        ON CONFLICT (professor, papel) DO UPDATE SET
+            aulas = analytics_professores.aulas + 1,
+            presencas = analytics_professores.presencas + EXCLUDED.presencas
+    """, p)
+
+    # quem já é acompanhado e faltou: mais uma aula e mais uma falta seguida
+    cur.execute("""
+        UPDATE analytics_alunos aa SET
+            aulas = aa.aulas + 1,
+            faltas_seguidas = aa.faltas_seguidas + 1,
+            maior_sequencia_faltas = GREATEST(aa.maior_sequencia_faltas, aa.faltas_seguidas + 1)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM frequencia f WHERE f.id_aula = %(aula)s AND f.id_aluno = aa.aluno_id
+        )
+    """, p)
+    # quem veio: zera a sequência (e passa a ser acompanhado a partir da primeira presença)
+    cur.execute("""
+        INSERT INTO analytics_alunos (aluno_id, presencas, aulas, faltas_seguidas, ultima_presenca)
+        SELECT f.id_aluno, 1, 1, 0, COALESCE(f.horario_entrada, a.data_aula)
+        FROM frequencia f JOIN aulas a ON a.id = f.id_aula
+        WHERE f.id_aula = %(aula)s AND f.id_aluno IS NOT NULL
+        ON CONFLICT (aluno_id) DO UPDATE SET
+            presencas = analytics_alunos.presencas + 1,
+            aulas = analytics_alunos.aulas + 1,
+            faltas_seguidas = 0,
+            ultima_presenca = GREATEST(analytics_alunos.ultima_presenca, EXCLUDED.ultima_presenca)
+    """, p)
+
+
+def taxa(presencas, aulas):
+    return round(presencas / aulas, 4) if aulas else None
+
+
+@app.get("/api/analytics/resumo")
+@require_auth
+@conditional("analytics_mensal", "analytics_alunos")
+def analytics_resumo():
+    """Totais gerais de frequência"""
+    try:
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT COALESCE(SUM(aulas), 0)::int AS aulas, COALESCE(SUM(presencas), 0)::int AS presencas
+                FROM analytics_mensal
+            """)
+            totais = cur.fetchone()
+            cur.execute("""
+                SELECT COUNT(*)::int AS acompanhados,
+                       COUNT(*) FILTER (WHERE faltas_seguidas >= 3)::int AS com_3_faltas_seguidas
+                FROM analytics_alunos
+            """)
+            alunos = cur.fetchone()
+        return jsonify({
+            "ok": True,
+            **totais,
+            "media_por_aula": round(totais["presencas"] / totais["aulas"], 2) if totais["aulas"] else None,
+            **alunos,
+        })
+    except Exception as e:
+        print("Erro em /api/analytics/resumo:", str(e))
+        return api_error("Erro ao carregar analytics", 500, e)
+
+
+@app.get("/api/analytics/alunos")
+@require_auth
+@conditional("analytics_alunos", "alunos")
+def analytics_alunos():
+    """Frequência por criança; ?min_faltas=N lista quem precisa de contato"""
+    try:
+        limit = min(int(request.args.get("limit") or 100), ANALYTICS_LIMIT_MAX)
+        min_faltas = int(request.args.get("min_faltas") or 0)
+    except ValueError:
+        return api_error("limit e min_faltas devem ser números", 400)
+    try:
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT aa.aluno_id, a.nome, a.responsavel, a.telefone,
+                       aa.presencas, aa.aulas, aa.faltas_seguidas, aa.maior_sequencia_faltas, aa.ultima_presenca
+                FROM analytics_alunos aa
+                JOIN alunos a ON a.id = aa.aluno_id
+                WHERE aa.faltas_seguidas >= %s
+                ORDER BY aa.faltas_seguidas DESC, aa.aluno_id
+                LIMIT %s
+            """, (min_faltas, limit))
+            rows = cur.fetchall()
+        for r in rows:
+            r["taxa_presenca"] = taxa(r["presencas"], r["aulas"])
+        return jsonify({"ok": True, "alunos": rows})
+    except Exception as e:
+        print("Erro em /api/analytics/alunos:", str(e))
+        return api_error("Erro ao carregar analytics", 500, e)
+
+
+@app.get("/api/analytics/alunos/<int:aluno_id>")
+@require_auth
+@conditional("analytics_alunos")
+def analytics_aluno(aluno_id):
+    try:
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT aluno_id, presencas, aulas, faltas_seguidas, maior_sequencia_faltas, ultima_presenca
+                FROM analytics_alunos WHERE aluno_id = %s
+            """, (aluno_id,))
+            row = cur.fetchone()
+        if not row:
+            # ainda não veio a nenhuma aula encerrada
+            row = {"aluno_id": aluno_id, "presencas": 0, "aulas": 0, "faltas_seguidas": 0,
+                   "maior_sequencia_faltas": 0, "ultima_presenca": None}
+        row["taxa_presenca"] = taxa(row["presencas"], row["aulas"])
+        return jsonify({"ok": True, **row})
+    except Exception as e:
+        print("Erro em /api/analytics/alunos/<id>:", str(e))
+        return api_error("Erro ao carregar analytics", 500, e)
+
+
+@app.get("/api/analytics/mensal")
+@require_auth
+@conditional("analytics_mensal")
+def analytics_mensal():
+    """Aulas e presenças por mês (?ano=AAAA)"""
+    try:
+        ano = int(request.args["ano"]) if request.args.get("ano") else None
+    except ValueError:
+        return api_error("ano inválido", 400)
+    try:
+        with db() as conn, conn.cursor() as cur:
+            if ano:
+                cur.execute("""
+                    SELECT mes, aulas, presencas FROM analytics_mensal
+                    WHERE mes >= make_date(%s, 1, 1) AND mes < make_date(%s + 1, 1, 1)
+                    ORDER BY mes
+                """, (ano, ano))
+            else:
+                cur.execute("SELECT mes, aulas, presencas FROM analytics_mensal ORDER BY mes")
+            rows = cur.fetchall()
+        for r in rows:
+            r["mes"] = r["mes"].strftime("%Y-%m")
+            r["media_por_aula"] = round(r["presencas"] / r["aulas"], 2) if r["aulas"] else None
+        return jsonify({"ok": True, "meses": rows})
+    except Exception as e:
+        print("Erro em /api/analytics/mensal:", str(e))
+        return api_error("Erro ao carregar analytics", 500, e)
+
+
+@app.get("/api/analytics/professores")
+@require_auth
+@conditional("analytics_professores")
+def analytics_professores():
+    """Aulas e presenças por professor/auxiliar"""
+    try:
+        with db() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT professor, papel, aulas, presencas FROM analytics_professores
+                ORDER BY aulas DESC, professor
+            """)
+            rows = cur.fetchall()
+        for r in rows:
+            r["media_por_aula"] = round(r["presencas"] / r["aulas"], 2) if r["aulas"] else None
+        return jsonify({"ok": True, "professores": rows})
+    except Exception as e:
+        print("Erro em /api/analytics/professores:", str(e))
+        return api_error("Erro ao carregar analytics", 500, e)
+
+
+# ==========================================================
+# MANUTENÇÃO
+# ==========================================================
+MEDIA_COLUMNS = [("alunos", "foto"), ("usuarios", "foto"), ("avisos", "imagem")]
+
+
+def media_keys():
+    """Chaves de todos os blobs referenciados nas colunas de imagem."""
+    keys = set()
+    with db() as conn, conn.cursor() as cur:
+        for tabela, coluna in MEDIA_COLUMNS:
+            cur.execute(f"SELECT DISTINCT {coluna} AS url FROM {tabela} WHERE {coluna} LIKE '/media/%%'")
+            for r in cur.fetchall():
+                m = MEDIA_URL_RE.match(r["url"])
+                if m:
+                    keys.add(m.group(1))
+    return sorted(keys)
+
+
+def blob_confirmado(key):
+    """Relê o blob do store e confere o hash antes de apagar a cópia base64."""
+    try:
+        with blobs.open(key) as f:
+            return hashlib.sha256(f.read()).hexdigest() == key
+    except Exception:
+        return False
+
+
+@cli_command("migrar-midia")
+def migrar_midia(args):
+    """Move imagens base64 antigas das colunas de texto para o blob store
+
+    O base64 só é trocado pela URL depois que o blob foi relido do store com o hash
+    certo, e só se a linha não mudou no meio tempo. Com um backend não durável (local)
+    recusa rodar sem --forcar: num `heroku run` o disco some junto com o dyno.
+    """
+    if not blobs.durable and "--forcar" not in args:
+        print(f"MEDIA_BACKEND={MEDIA_BACKEND} guarda os arquivos só no disco desta máquina; "
+              "migrar apagaria o base64 de imagens que os outros servidores não enxergam.")
+        print("Configure o Supabase Storage (SUPABASE_URL, SUPABASE_SERVICE_KEY) ou rode com --forcar.")
+        sys.exit(1)
+
+    for tabela, coluna in MEDIA_COLUMNS:
+        movidas = falhas = 0
+        ultimo_id = 0
+        while True:
+            with db() as conn, conn.cursor() as cur:
+                cur.execute(f"""
+                    SELECT id, {coluna} AS valor
+                    FROM {tabela}
+                    WHERE id > %s AND {coluna} IS NOT NULL AND {coluna} NOT LIKE '/media/%%'
+                    ORDER BY id
+                    LIMIT 50
+                """, (ultimo_id,))
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                for r in rows:
+                    ultimo_id = r["id"]
+                    try:
+                        url = store_image(r["valor"])
+                    except Exception as e:
+                        falhas += 1
+                        print(f"  {tabela}#{r['id']}: {e}")
+                        continue
+                    if not url:
+                        continue
+                    if not blob_confirmado(MEDIA_URL_RE.match(url).group(1)):
+                        falhas += 1
+                        print(f"  {tabela}#{r['id']}: blob não confirmado no store, base64 mantido")
+                        continue
+                    cur.execute(f"UPDATE {tabela} SET {coluna}=%s WHERE id=%s AND {coluna}=%s",
+                                (url, r["id"], r["valor"]))
+                    movidas += cur.rowcount
+                conn.commit()
+        print(f"{tabela}.{coluna}: {movidas} migradas, {falhas} com falha")
+
+
+@cli_command("recontar-avisos")
+def recontar_avisos(args):
+    """Recalcula like_count e comment_count de todos os avisos a partir das tabelas de origem"""
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE avisos a
+            SET like_count = COALESCE(l.total, 0),
+                comment_count = COALESCE(c.total, 0)
+            FROM avisos x
+            LEFT JOIN (SELECT aviso_id, COUNT(*) AS total FROM avisos_likes GROUP BY aviso_id) l
+                   ON l.aviso_id = x.id
+            LEFT JOIN (SELECT aviso_id, COUNT(*) AS total FROM avisos_comentarios GROUP BY aviso_id) c
+                   ON c.aviso_id = x.id
+            WHERE a.id = x.id
+              AND (a.like_count <> COALESCE(l.total, 0) OR a.comment_count <> COALESCE(c.total, 0))
+        """)
+        corrigidos = cur.rowcount
+        conn.commit()
+    print(f"{corrigidos} avisos corrigidos")
+
+
+@cli_command("importar-alunos")
+def importar_alunos_cli(args):
+    """python server.py importar-alunos arquivo.csv [latin1]"""
+    if not args:
+        print("Uso: python server.py importar-alunos arquivo.csv [encoding]")
+        sys.exit(2)
+    encoding = IMPORT_ENCODINGS.get((args[1] if len(args) > 1 else "utf8").lower())
+    if not encoding:
+        print("encoding não suportado:", args[1])
+        sys.exit(2)
+    with open(args[0], "rb") as f:
+        try:
+            relatorio = importar_alunos(f, encoding)
+        except ValueError as e:
+            print("Falha:", e)
+            sys.exit(1)
+    print(f"{relatorio['lidas']} linhas lidas: {relatorio['inseridos']} inseridas, "
+          f"{relatorio['atualizados']} atualizadas, {relatorio['rejeitados']} rejeitadas")
+    for erro in relatorio["erros"]:
+        print(f"  linha {erro['linha']}: {erro['motivo']}")
+
+
+@cli_command("recalcular-analytics")
+def recalcular_analytics(args):
+    """Refaz os agregados de analytics a partir de todas as aulas encerradas"""
+    with db() as conn, conn.cursor() as cur:
+        cur.execute("""
+            TRUNCATE analytics_aulas_processadas, analytics_alunos, analytics_mensal, analytics_professores
+        """)
+        cur.execute("SELECT id FROM aulas WHERE encerrada_em IS NOT NULL ORDER BY data_aula, id")
+        aulas = [r["id"] for r in cur.fetchall()]
+        # em ordem cronológica, para as sequências de faltas saírem certas
+        for aula_id in aulas:
+            analytics_processar_aula(cur, aula_id)
+        conn.commit()
+    print(f"analytics recalculado com {len(aulas)} aulas")
+
+
+@cli_command("gerar-miniaturas")
+def gerar_miniaturas(args):
+    """Gera as variantes que faltam para todas as imagens referenciadas no banco"""
+    if Image is None:
+        print("Pillow não instalado; nada a fazer.")
+        return
+    geradas = falhas = 0
+    for key in media_keys():
+        try:
+            render_variants(key)
+            geradas += 1
+        except Exception as e:
+            falhas += 1
+            print(f"  {key}: {e}")
+    print(f"{geradas} imagens processadas, {falhas} com falha")
+
+
 # ==========================================================
 # INICIALIZAÇÃO DO SERVIDOR
 # ==========================================================
 if __name__ == "__main__":
-    import os
+    if len(sys.argv) > 1:
+        comando = CLI_COMMANDS.get(sys.argv[1])
+        if comando is None:
+            print("Comandos disponíveis:", ", ".join(sorted(CLI_COMMANDS)))
+            sys.exit(2)
+        comando(sys.argv[2:])
+        sys.exit(0)
+
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
@@ -72,9 +72,16 @@ async function fileToBase64(file) {
   });
 }
 
+// imagens novas chegam como URL (/media/<hash>); as antigas ainda podem vir em base64
+function imgSrc(v) {
+  if (!v) return "";
+  if (v.startsWith("/") || v.startsWith("http")) return esc(v);
+  return `data:image/*;base64,${v}`;
+}
+
 function b64ImgTag(b64, alt = "") {
   if (!b64) return "";
-  return `<img src="data:image/*;base64,${b64}" alt="${esc(alt)}">`;
+  return `<img src="${imgSrc(b64)}" alt="${esc(alt)}" loading="lazy">`;
 }
 
 function isAdmin(user) {
@@ -234,9 +241,83 @@ const APP = {
       return;
     }
     this.showScreen("app");
+    this.startEventos();
     await this.go("home");
   },
 
+  /* ---------------- Tempo real (SSE) ---------------- */
+  // o token da sessão não vai na URL (ela aparece nos logs): cada conexão usa um token
+  // curto, só de eventos. Com ele vencido a reconexão automática leva 401 e o EventSource
+  // desiste, então o app pede outro token e abre de novo (com resync)
+  async startEventos(reconexao = false) {
+    this.stopEventos();
+    if (!Auth.token || !window.EventSource) return;
+    const seq = this.eventosSeq;
+    let token;
+    try {
+      token = (await apiFetch("/eventos/token", { method: "POST" })).token;
+    } catch (e) {
+      if (e.status !== 401) this.agendarEventos();
+      return;
+    }
+    if (seq !== this.eventosSeq || !Auth.token) return;
+    const qs = new URLSearchParams({ token });
+    if (reconexao) qs.set("reconexao", "1");
+    const es = new EventSource(`${API}/eventos?${qs}`);
+    es.onerror = () => {
+      if (es.readyState === EventSource.CLOSED && this.eventos === es) this.agendarEventos();
+    };
+    const on = (tipo, fn) => es.addEventListener(tipo, (ev) => {
+      try { fn(JSON.parse(ev.data || "{}")); } catch (e) { console.warn(e); }
+    });
+    on("checkin", (d) => this.applyPresenca(d.aula_id, {
+      frequencia_id: d.frequencia_id, aluno_id: d.aluno_id, nome: d.nome,
+      horario_entrada: d.horario_entrada, horario_saida: null, retirado_por: null
+    }));
+    on("checkout", (d) => this.applyPresenca(d.aula_id, {
+      frequencia_id: d.frequencia_id, horario_saida: d.horario_saida, retirado_por: d.retirado_por
+    }));
+    on("aula", () => { if (this.page === "aulas") this.refreshAulaAtivaUI(); });
+    on("resync", () => { if (this.page === "aulas") this.refreshAulaAtivaUI(); });
+    on("aviso", (d) => {
+      if (d.acao === "likes" || d.acao === "comentarios") {
+        const sel = d.acao === "likes" ? `[data-like="${d.id}"]` : `[data-coments="${d.id}"]`;
+        const icon = d.acao === "likes" ? "fa-heart" : "fa-comment";
+        const count = d.acao === "likes" ? d.like_count : d.comment_count;
+        $$(sel).forEach(b => { b.innerHTML = `<i class="fa-solid ${icon}"></i> ${count ?? 0}`; });
+        return;
+      }
+      if (this.page === "mural") this.loadAvisos();
+    });
+    this.eventos = es;
+  },
+
+  agendarEventos() {
+    clearTimeout(this.eventosTimer);
+    this.eventosTimer = setTimeout(() => this.startEventos(true), 3000 + Math.random() * 5000);
+  },
+
+  stopEventos() {
+    // invalida um startEventos que ainda esteja esperando o token
+    this.eventosSeq = (this.eventosSeq || 0) + 1;
+    clearTimeout(this.eventosTimer);
+    if (this.eventos) this.eventos.close();
+    this.eventos = null;
+  },
+
+  // aplica um delta de presença na lista local, sem buscar a lista inteira de novo
+  applyPresenca(aulaId, delta) {
+    if (this.page !== "aulas" || !this.aulaAtiva || this.aulaAtiva.id !== aulaId) return;
+    const lista = this.presentes || [];
+    const atual = lista.find(p => p.frequencia_id === delta.frequencia_id);
+    if (atual) Object.assign(atual, delta);
+    else if (delta.aluno_id) lista.push(delta);
+    else return this.refreshAulaAtivaUI();
+    lista.sort((a, b) => (a.nome || "").localeCompare(b.nome || "", "pt-BR"));
+    this.presentes = lista;
+    this.renderPresentes();
+  },
+
   bindEvents() {
     $$(".side-item").forEach(btn => {
       btn.addEventListener("click", async () => {
@@ -312,6 +393,7 @@ const APP = {
       this.me = me;
       this.paintUser();
       this.showScreen("app");
+      this.startEventos();
       await this.go("home");
       toast("Bem-vindo!", "ok");
     } catch (e) {
@@ -323,6 +405,7 @@ const APP = {
   },
 
   async logout() {
+    this.stopEventos();
     Auth.save("");
     this.me = null;
     this.showScreen("login");
@@ -545,6 +628,31 @@ const APP = {
         }
         // guarda pra resolver nome -> id no clique
         window.__ALUNOS_CACHE__ = alunosList;
+
+        // sugestões conforme digita (índice em memória do servidor)
+        let sugTimer = null;
+        selEntrada.addEventListener("input", () => {
+          clearTimeout(sugTimer);
+          const q = selEntrada.value.trim();
+          if (q.length < 2) return;
+          sugTimer = setTimeout(async () => {
+            try {
+              const data = await apiFetch(`/alunos/sugestoes?q=${encodeURIComponent(q)}`);
+              const sugestoes = data?.sugestoes || [];
+              const cache = window.__ALUNOS_CACHE__ || [];
+              const ids = new Set(cache.map(a => a.id));
+              sugestoes.forEach(a => { if (!ids.has(a.id)) cache.push(a); });
+              window.__ALUNOS_CACHE__ = cache;
+              if (dl) {
+                dl.innerHTML = sugestoes
+                  .map(a => `<option data-id="${a.id}" value="${esc(a.nome)}"></option>`)
+                  .join("");
+              }
+            } catch (e) {
+              console.warn(e);
+            }
+          }, 150);
+        });
       }
 
       $("#btn-iniciar-aula")?.addEventListener("click", async () => {
@@ -628,6 +736,8 @@ const APP = {
       const aula = data?.aula;
 
       if (!aula) {
+        this.aulaAtiva = null;
+        this.presentes = [];
         if (box) box.innerHTML = `<div class="hint">Nenhuma aula ativa no momento.</div>`;
         if (list) list.innerHTML = `<div class="hint">Inicie uma aula para registrar presença.</div>`;
         if (btnEncerrar) btnEncerrar.style.display = "none";
@@ -646,39 +756,9 @@ const APP = {
       if (btnEncerrar) btnEncerrar.style.display = "";
 
       const pres = await apiFetch(`/aulas/presentes?aula_id=${encodeURIComponent(aula.id)}`);
-      const presentes = pres?.presentes || [];
-
-      if (list) {
-        if (!presentes.length) {
-          list.innerHTML = `<div class="hint">Ainda ninguém deu entrada.</div>`;
-        } else {
-          list.innerHTML = presentes.map(p => {
-            const saiu = !!p.horario_saida;
-            const entradaTime = formatTimeBR(p.horario_entrada);
-            const saidaTime = formatTimeBR(p.horario_saida);
-            const right = saiu
-              ? `<span class="tag">Saiu ${saidaTime} (${esc(p.retirado_por || "-")})</span>`
-              : `<button class="btn btn-warn btn-sm" data-checkout="${p.frequencia_id}" data-aluno="${p.aluno_id}">Checkout</button>`;
-            return `
-              <div class="item">
-                <div class="item-left">
-                  <div class="item-title">${esc(p.nome)}</div>
-                  <div class="item-sub">Entrada: ${entradaTime}</div>
-                </div>
-                <div class="item-actions">${right}</div>
-              </div>
-            `;
-          }).join("");
-
-          $$("[data-checkout]", list).forEach(btn => {
-            btn.addEventListener("click", async () => {
-              const fid = Number(btn.getAttribute("data-checkout"));
-              const alunoId = Number(btn.getAttribute("data-aluno"));
-              await this.openCheckoutModal(fid, alunoId);
-            });
-          });
-        }
-      }
+      this.aulaAtiva = aula;
+      this.presentes = pres?.presentes || [];
+      this.renderPresentes();
     } catch (e) {
       console.error("Erro em refreshAulaAtivaUI:", e);
       if (box) box.innerHTML = `<div class="hint">Falha ao carregar aula ativa.</div>`;
@@ -687,6 +767,41 @@ const APP = {
     }
   },
 
+  renderPresentes() {
+    const list = $("#lista-presentes");
+    if (!list) return;
+    const presentes = this.presentes || [];
+    if (!presentes.length) {
+      list.innerHTML = `<div class="hint">Ainda ninguém deu entrada.</div>`;
+      return;
+    }
+    list.innerHTML = presentes.map(p => {
+      const saiu = !!p.horario_saida;
+      const entradaTime = formatTimeBR(p.horario_entrada);
+      const saidaTime = formatTimeBR(p.horario_saida);
+      const right = saiu
+        ? `<span class="tag">Saiu ${saidaTime} (${esc(p.retirado_por || "-")})</span>`
+        : `<button class="btn btn-warn btn-sm" data-checkout="${p.frequencia_id}" data-aluno="${p.aluno_id}">Checkout</button>`;
+      return `
+        <div class="item">
+          <div class="item-left">
+            <div class="item-title">${esc(p.nome)}</div>
+            <div class="item-sub">Entrada: ${entradaTime}</div>
+          </div>
+          <div class="item-actions">${right}</div>
+        </div>
+      `;
+    }).join("");
+
+    $$("[data-checkout]", list).forEach(btn => {
+      btn.addEventListener("click", async () => {
+        const fid = Number(btn.getAttribute("data-checkout"));
+        const alunoId = Number(btn.getAttribute("data-aluno"));
+        await this.openCheckoutModal(fid, alunoId);
+      });
+    });
+  },
+
   async openCheckoutModal(frequenciaId, alunoId) {
     try {
       let aluno = null;
@@ -1292,7 +1407,7 @@ const APP = {
           ${a.mensagem ? `<div style="margin:8px 0 10px;color:var(--text);font-weight:600">${esc(a.mensagem)}</div>` : ""}
           ${a.imagem ? `
             <div class="aviso-img">
-              <img src="data:image/*;base64,${a.imagem}" alt="imagem do aviso">
+              <img src="${imgSrc(a.imagem)}" alt="imagem do aviso" loading="lazy">
             </div>
           ` : ""}
           <div class="aviso-actions">
@@ -1455,7 +1570,7 @@ const APP = {
           ${aviso.mensagem ? `<div style="margin-top:10px;font-weight:650">${esc(aviso.mensagem)}</div>` : ""}
           ${aviso.imagem ? `
             <div class="aviso-img" style="margin-top:12px">
-              <img src="data:image/*;base64,${aviso.imagem}" alt="imagem do aviso">
+              <img src="${imgSrc(aviso.imagem)}" alt="imagem do aviso">
             </div>
           ` : ""}
           <div class="aviso-actions" style="margin-top:12px">
@@ -1,5 +1,5 @@
-/* Kid IEQ 2025 - sw.js (v6 - atualiza sem limpar cache) */
-const CACHE = "kid-ieq-cache-v6";
+/* Kid IEQ 2025 - sw.js (v7 - só guarda mídia imutável) */
+const CACHE = "kid-ieq-cache-v7";
 
 const CORE = [
   "/",
@@ -48,6 +48,22 @@ async function networkFirst(req) {
   }
 }
 
+// só respostas marcadas como imutáveis pelo servidor; redirects (miniatura ainda
+// não gerada) não entram, senão o original ficaria para sempre no lugar dela
+function isImmutable(resp) {
+  return resp && resp.ok && !resp.redirected &&
+    (resp.headers.get("Cache-Control") || "").includes("immutable");
+}
+
+async function cacheFirst(req) {
+  const cache = await caches.open(CACHE);
+  const cached = await cache.match(req);
+  if (cached) return cached;
+  const resp = await fetch(req);
+  if (isImmutable(resp)) cache.put(req, resp.clone()).catch(() => {});
+  return resp;
+}
+
 async function staleWhileRevalidate(req) {
   const cache = await caches.open(CACHE);
   const cached = await cache.match(req);
@@ -65,6 +81,9 @@ self.addEventListener("fetch", (event) => {
 
   if (req.method !== "GET") return;
 
+  // stream de eventos fica fora do service worker
+  if (url.pathname === "/api/eventos") return;
+
   // API sempre rede
   if (url.pathname.startsWith("/api/")) {
     event.respondWith(
@@ -76,6 +95,12 @@ self.addEventListener("fetch", (event) => {
     return;
   }
 
+  // mídia é endereçada por hash: o conteúdo de uma URL nunca muda
+  if (url.pathname.startsWith("/media/")) {
+    event.respondWith(cacheFirst(req));
+    return;
+  }
+
   // navegação (index) e arquivos críticos: network-first pra não "grudar" versão antiga
   const isNav = req.mode === "navigate";
   const isCritical =